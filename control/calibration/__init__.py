@@ -1,2 +1,3 @@
 from .calibrations import *
-from .magnet_response_calibration import MagnetHystCalib
\ No newline at end of file
+from .magnet_response_calibration import MagnetHystCalib
+from .calibration_cache import CalibrationCache
@@ -0,0 +1,129 @@
+import os
+import copy
+import pickle
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+import numpy as np
+
+
+def hash_update(h, value):
+    """Adds the value (numbers, strings, arrays, dataframes and lists, tuples or dicts of them) to the hash h"""
+    if hasattr(value, 'index') and hasattr(value, 'values'):
+        # dataframes and series: the values, the index and the column names
+        hash_update(h, (type(value).__name__, getattr(value, 'columns', None), value.index.values, value.values))
+    elif isinstance(value, np.ndarray):
+        value = np.ascontiguousarray(value)
+        h.update('{}{}'.format(value.dtype.str, value.shape).encode())
+        if value.dtype == object:
+            hash_update(h, value.tolist())
+        else:
+            h.update(memoryview(value).cast('B'))
+    elif isinstance(value, dict):
+        h.update(b'{')
+        for key in sorted(value, key=repr):
+            hash_update(h, key)
+            hash_update(h, value[key])
+        h.update(b'}')
+    elif isinstance(value, (list, tuple)) or (hasattr(value, '__iter__') and not isinstance(value, (str, bytes))):
+        h.update(b'[')
+        for v in value:
+            hash_update(h, v)
+        h.update(b']')
+    else:
+        h.update(repr(value).encode())
+        h.update(b';')
+
+
+class CalibrationCache:
+    """Least recently used cache of calibration.data2inst results, so staging the same physical signal again only
+    costs hashing it (e.g. 250 identical loops of a loop map are only inverted through the hysteresis model once).
+
+    The key is the hash of the calibration state (InstrumentCalibration.cache_key, which also covers the starting
+    hysteresis state), the data (values, index and columns) and the keyword arguments. Calibrations which return
+    None as their cache_key are not cached. If directory is given, the results are also pickled there and
+    survive restarts of the program.
+
+        Args:
+            max_entries (int): number of results kept in memory. 0 turns the cache off
+            directory (str): directory where the results are kept on disk, None to only keep them in memory
+    """
+
+    def __init__(self, max_entries=4, directory=None):
+        self.max_entries = int(max_entries)
+        self.directory = directory
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, calibration, data, **kwargs):
+        """Returns the key of calibration.data2inst(data, **kwargs), or None if the calibration can not be cached"""
+        calibration_key = calibration.cache_key()
+        if calibration_key is None:
+            return None
+        h = hashlib.sha1()
+        hash_update(h, (type(calibration).__name__, calibration_key, data, kwargs))
+        return h.hexdigest()
+
+    def get(self, key):
+        """Returns a copy of the result stored under the key, None if there is none"""
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                return copy.deepcopy(self.entries[key])
+        if self.directory is None:
+            return None
+        try:
+            with open(self.get_path(key), 'rb') as fp:
+                result = pickle.load(fp)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+        self.put(key, result, write=False)
+        return copy.deepcopy(result)
+
+    def put(self, key, result, write=True):
+        """Stores a copy of the result under the key, dropping the least recently used entries"""
+        result = copy.deepcopy(result)
+        with self.lock:
+            self.entries[key] = result
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        if write and self.directory is not None:
+            # write to a temporary file first, so that a half written file is never read
+            fd, path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+            with os.fdopen(fd, 'wb') as fp:
+                pickle.dump(result, fp)
+            os.replace(path, self.get_path(key))
+
+    def get_path(self, key):
+        return os.path.join(self.directory, key + '.p')
+
+    def data2inst(self, calibration, data, **kwargs):
+        """Returns calibration.data2inst(data, **kwargs), taken from the cache if it was computed before"""
+        if self.max_entries <= 0 and self.directory is None:
+            return calibration.data2inst(data, **kwargs)
+        key = self.key(calibration, data, **kwargs)
+        if key is None:
+            return calibration.data2inst(data, **kwargs)
+        result = self.get(key)
+        if result is not None:
+            self.hits += 1
+            return result
+        self.misses += 1
+        result = calibration.data2inst(data, **kwargs)
+        self.put(key, result)
+        return result
+
+    def clear(self, disk=False):
+        """Empties the cache in memory, and on disk if disk is True"""
+        with self.lock:
+            self.entries.clear()
+        if disk and self.directory is not None:
+            for name in os.listdir(self.directory):
+                if name.endswith('.p'):
+                    os.remove(os.path.join(self.directory, name))
@@ -28,6 +28,120 @@ class InstrumentCalibration:
     def data2inst(self, data, **kwargs):
         return data
 
+    def get_inst2data_affine(self):
+        """If inst2data is affine, returns (matrix, offset) so that data = raw.dot(matrix) + offset, otherwise None.
+        A matrix which is a number or a vector multiplies the columns elementwise.
+        Lets the instruments calibrate numpy arrays in place, without going through dataframes"""
+        if type(self).inst2data is InstrumentCalibration.inst2data:
+            return 1., 0.
+        return None
+
+    def get_data2inst_affine(self):
+        """If data2inst is exactly an affine map, returns its (matrix, offset) as get_inst2data_affine does,
+        otherwise None"""
+        if type(self).data2inst is InstrumentCalibration.data2inst:
+            return 1., 0.
+        return None
+
+    def is_separable(self):
+        """True if every column of data2inst only depends on the same column of the data, so that the ports can be
+        calibrated separately (e.g. over different periods). Only holds when data2inst is exactly an affine map with a
+        diagonal matrix: calibrations which check the range of all the columns together (e.g. NanoCubeCalib) are not"""
+        affine = self.get_data2inst_affine()
+        if affine is None:
+            return False
+        matrix = affine[0]
+        return np.ndim(matrix) < 2 or np.count_nonzero(matrix - np.diag(np.diagonal(matrix))) == 0
+
+    def cache_key(self):
+        """Returns something describing everything data2inst depends on besides the data (parameters, starting
+        state, ...), so that its results can be reused by a CalibrationCache. None means data2inst should not be cached,
+        which is the default: it is only worth it for expensive calibrations, and some depend on other instruments"""
+        return None
+
+
+def apply_affine(data, affine):
+    """Applies the (matrix, offset) returned by get_inst2data_affine to the 2D numpy array data in place"""
+    matrix, offset = affine
+    if np.ndim(matrix) == 0 and matrix == 1 and np.ndim(offset) == 0 and offset == 0:
+        return data
+    if np.ndim(matrix) == 2:
+        data[:] = data.dot(matrix)
+    else:
+        data *= matrix
+    data += offset
+    return data
+
+
+def compose_affine(*affines):
+    """Returns the single (matrix, offset) doing the affine maps one after another (first one first)"""
+    matrix, offset = affines[0]
+    for next_matrix, next_offset in affines[1:]:
+        if np.ndim(next_matrix) == 2:
+            matrix = np.dot(matrix, next_matrix) if np.ndim(matrix) == 2 else np.asarray(matrix)[..., None] * next_matrix
+            offset = np.dot(offset, next_matrix)
+        else:
+            matrix = matrix * next_matrix
+            offset = np.multiply(offset, next_matrix)
+        offset = offset + next_offset
+    return matrix, offset
+
+
+def invert_affine(affine):
+    """Returns the (matrix, offset) undoing the affine map"""
+    matrix, offset = affine
+    if np.ndim(matrix) == 2:
+        inverse = np.linalg.inv(matrix)
+        return inverse, -np.dot(offset, inverse)
+    return 1 / np.asarray(matrix, dtype=float), -np.divide(offset, matrix)
+
+
+class AffineCalibration(InstrumentCalibration):
+    """Calibration where data = raw.dot(matrix) + offset. The subclasses return (matrix, offset) from compute_affine,
+    it is computed (together with its inverse for data2inst) only once and again whenever one of affine_attributes
+    is set. Both directions are then a single matrix multiplication, and a chain of affine steps (e.g. scale and
+    rotation) is composed into one map with compose_affine"""
+    # attributes compute_affine depends on
+    affine_attributes = ('scale', 'offset', 'xy_rotation_angle')
+
+    def __setattr__(self, name, value):
+        if name in self.affine_attributes:
+            self.__dict__.pop('affine', None)
+            self.__dict__.pop('inverse_affine', None)
+        object.__setattr__(self, name, value)
+
+    def compute_affine(self):
+        raise NotImplementedError
+
+    def get_inst2data_affine(self):
+        if 'affine' not in self.__dict__:
+            self.affine = self.compute_affine()
+        return self.affine
+
+    def get_inverse_affine(self):
+        """Returns the (matrix, offset) undoing get_inst2data_affine"""
+        if 'inverse_affine' not in self.__dict__:
+            self.inverse_affine = invert_affine(self.get_inst2data_affine())
+        return self.inverse_affine
+
+    def get_data2inst_affine(self):
+        # subclasses which check or clip in data2inst are not just the inverse map
+        if type(self).data2inst is not AffineCalibration.data2inst:
+            return None
+        return self.get_inverse_affine()
+
+    def inst2data(self, data):
+        if data.shape[0] == 0:
+            return data
+        return pd.DataFrame(apply_affine(np.array(data, dtype=float), self.get_inst2data_affine()),
+                            columns=data.columns, index=data.index)
+
+    def data2inst(self, data):
+        if data.shape[0] == 0:
+            return data
+        return pd.DataFrame(apply_affine(np.array(data, dtype=float), self.get_inverse_affine()),
+                            columns=data.columns, index=data.index)
+
 
 class ScaleCalib(InstrumentCalibration):
     def __init__(self, parameters):
@@ -68,6 +182,9 @@ class TemperatureCalibration(InstrumentCalibration):
         data += self.scale
         return data
 
+    def get_inst2data_affine(self):
+        return self.offset, self.scale
+
     def data2inst(self, data):
         if data.shape[0] == 0:
             return data
@@ -86,7 +203,7 @@ class Reference(InstrumentCalibration):
         return pd.DataFrame().reindex_like(data).fillna(value=self.offset)
 
 
-class NIoffsetScale(InstrumentCalibration):
+class NIoffsetScale(AffineCalibration):
     """Offset and scales the data by the given parameters. Accepts both numbers and matrices/vectors for offset"""
 
     def __init__(self, parameters):
@@ -99,22 +216,10 @@ class NIoffsetScale(InstrumentCalibration):
         if self.scale.ndim == 0:
             self.scale = self.scale[None, None]
 
-    def data2inst(self, data):
-        if data.shape[0] == 0:
-            return data
-        data_calib = pd.DataFrame(np.array(data - self.offset).dot(np.linalg.inv(np.transpose(self.scale))),
-                                  columns=data.columns,
-                                  index=data.index)
-        return data_calib
-
-    def inst2data(self, data):
-        if data.shape[0] == 0:
-            return data
-        data_calib = pd.DataFrame(np.array(data).dot(np.transpose(self.scale)) + self.offset, columns=data.columns,
-                                  index=data.index)
-        return data_calib
+    def compute_affine(self):
+        return np.transpose(self.scale), self.offset
 
-class SENISSampleCalib(InstrumentCalibration):
+class SENISSampleCalib(AffineCalibration):
     """Offset and scales the data by the given parameters. Accepts both numbers and matrices/vectors for offset"""
 
     def __init__(self, parameters):
@@ -141,27 +246,9 @@ class SENISSampleCalib(InstrumentCalibration):
         R = np.array([[c, -s, 0], [s, c, 0], [0, 0, 1]])
         return R
 
-    def data2inst(self, data):
-        if data.shape[0] == 0:
-            return data
-        # get the matrix to rotate senis FOR to table FOR
-        R = self.get_xyrotation_matrix()
-        data_calib = pd.DataFrame((np.array(data).dot(np.linalg.inv(R)) - self.offset).dot(np.linalg.inv(np.transpose(self.scale))),
-                                  columns=data.columns,
-                                  index=data.index)
-        return data_calib
-
-    def inst2data(self, data):
-        if data.shape[0] == 0:
-            return data
-        # get the matrix to rotate senis FOR to table FOR
-        R = self.get_xyrotation_matrix()
-        # combine the transformations
-        M = np.transpose(self.scale).dot(R)
-        off = self.offset.dot(R)
-        data_calib = pd.DataFrame(np.array(data).dot(M) + off, columns=data.columns,
-                                  index=data.index)
-        return data_calib
+    def compute_affine(self):
+        # scale into the senis FOR, then rotate it into the table FOR
+        return compose_affine((np.transpose(self.scale), self.offset), (self.get_xyrotation_matrix(), 0))
 
 
 class StageSampleRefCalib(InstrumentCalibration):
@@ -315,8 +402,11 @@ class NanoCubeCalib(NIoffsetScale):
         data_calib = (data - self.offset) / self.scale
         return data_calib
 
+    def compute_affine(self):
+        return 1 / self.scale, -self.offset / self.scale
+
 
-class HPSampleCalib(InstrumentCalibration):
+class HPSampleCalib(AffineCalibration):
     """Offset and scales the data by the given parameters. Accepts both numbers and matrices/vectors for offset"""
 
     def __init__(self, parameters):
@@ -343,27 +433,9 @@ class HPSampleCalib(InstrumentCalibration):
         R = np.array([[c, -s, 0], [s, c, 0], [0, 0, 1]])
         return R
 
-    def data2inst(self, data):
-        if data.shape[0] == 0:
-            return data
-        # get the matrix to rotate senis FOR to table FOR
-        R = self.get_xyrotation_matrix()
-        data_calib = pd.DataFrame((np.array(data).dot(np.linalg.inv(R)) - self.offset).dot(np.linalg.inv(np.transpose(self.scale))),
-                                  columns=data.columns,
-                                  index=data.index)
-        return data_calib
-
-    def inst2data(self, data):
-        if data.shape[0] == 0:
-            return data
-        # get the matrix to rotate senis FOR to table FOR
-        R = self.get_xyrotation_matrix()
-        # combine the transformations
-        M = np.transpose(self.scale).dot(R)
-        off = self.offset.dot(R)
-        data_calib = pd.DataFrame(np.array(data).dot(M) + off, columns=data.columns,
-                                  index=data.index)
-        return data_calib
+    def compute_affine(self):
+        # scale into the senis FOR, then rotate it into the table FOR
+        return compose_affine((np.transpose(self.scale), self.offset), (self.get_xyrotation_matrix(), 0))
 
 
 class SmaractScaleCalib(InstrumentCalibration):
@@ -1,7 +1,13 @@
-from .calibrations import InstrumentCalibration
+from .calibrations import InstrumentCalibration, apply_affine
+from .calibration_cache import hash_update
+import os
+import hashlib
+import tempfile
 import numpy as np
 import pandas as pd
 import pickle
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from numba import njit
 from warnings import warn
 from scipy.stats import binned_statistic
@@ -60,9 +66,10 @@ def get_hystline_signal(L, F_fun):
     return signal
 
 
-def reconstruct_hyst_signal(signal, L_start, F_fun):
+def reconstruct_hyst_signal_reference(signal, L_start, F_fun):
     """Adjust for the hysteresis of the signal given the starting Preisach line
-    and the integral F functions of the Preisach model"""
+    and the integral F functions of the Preisach model.
+    Plain python version of reconstruct_hyst_signal, kept as the reference it is checked against"""
     # define the starting line
     L = np.array(L_start.copy()).astype(float)
     signal_out = np.zeros(len(signal))
@@ -72,6 +79,182 @@ def reconstruct_hyst_signal(signal, L_start, F_fun):
     return signal_out, L
 
 
+@njit(cache=True)
+def update_hyst_stack(L, m, x):
+    """Same as update_hyst_line, but on the first m rows of the preallocated L (which needs at least m + 1 rows).
+    Returns the new number of rows and the first row which changed"""
+    if L[m - 1, 0] < x:
+        # went up, the alphas smaller than x are wiped out
+        col = 0
+        first = m
+        for i in range(m):
+            if L[i, 0] < x:
+                L[i, 0] = x
+                first = min(first, i)
+    elif L[m - 1, 0] > x:
+        # went down, the betas bigger than x are wiped out
+        col = 1
+        first = m
+        for i in range(m):
+            if L[i, 1] > x:
+                L[i, 1] = x
+                first = min(first, i)
+    else:
+        return m, m
+    # add the newest element
+    L[m, 0] = x
+    L[m, 1] = x
+    m += 1
+    # every other element needs to have a different alpha (beta going down), otherwise it is removed
+    keep = np.zeros(m, dtype=np.bool_)
+    keep[0] = True
+    keep[m - 1] = True
+    for i in range(m - 2):
+        if L[i, col] != L[i + 1, col]:
+            keep[i] = True
+            keep[i + 1] = True
+    n = 0
+    for i in range(m):
+        if keep[i]:
+            if n != i:
+                L[n, 0] = L[i, 0]
+                L[n, 1] = L[i, 1]
+                first = min(first, n)
+            n += 1
+    return n, first
+
+
+@njit(cache=True)
+def hyst_line_points(signal, L_start):
+    """Runs the Preisach line through the signal, keeping it as a stack with room for one new row per sample.
+    Only the rows which changed need a new F value, so for every sample this returns the first changed row and the
+    number of rows, and all changed rows in order (starting with the whole starting line).
+    Returns (points, first, lengths, final line)"""
+    n = signal.size
+    m = L_start.shape[0]
+    L = np.empty((m + n + 1, 2))
+    L[:m] = L_start
+    points = np.empty((2 * (m + n) + 16, 2))
+    points[:m] = L_start
+    n_points = m
+    first = np.empty(n, dtype=np.int64)
+    lengths = np.empty(n, dtype=np.int64)
+    for k in range(n):
+        m, f = update_hyst_stack(L, m, signal[k])
+        first[k] = f
+        lengths[k] = m
+        if n_points + m - f > points.shape[0]:
+            grown = np.empty((2 * points.shape[0] + m, 2))
+            grown[:n_points] = points[:n_points]
+            points = grown
+        points[n_points:n_points + m - f] = L[f:m]
+        n_points += m - f
+    return points[:n_points], first, lengths, L[:m].copy()
+
+
+@njit(cache=True)
+def hyst_line_signal(F_points, beta_points, n_start, first, lengths):
+    """Replays the stack of hyst_line_points with the F values of its points and returns the signal of the line
+    after every sample (as get_hystline_signal)"""
+    n = first.size
+    capacity = n_start + n + 1
+    F_line = np.empty(capacity)
+    beta_line = np.empty(capacity)
+    F_line[:n_start] = F_points[:n_start]
+    beta_line[:n_start] = beta_points[:n_start]
+    p = n_start
+    signal_out = np.empty(n)
+    for k in range(n):
+        for r in range(first[k], lengths[k]):
+            F_line[r] = F_points[p]
+            beta_line[r] = beta_points[p]
+            p += 1
+        # sum over the horizontal lines
+        total = 0.
+        for i in range(lengths[k] - 1):
+            if beta_line[i + 1] != beta_line[i]:
+                total += F_line[i] - F_line[i + 1]
+        signal_out[k] = -F_line[0] + 2 * total
+    return signal_out
+
+
+@njit(cache=True)
+def bilinear_grid(lower, step, values, a, b, out):
+    """Bilinear interpolation of values, given on the square grid lower + step * i in both directions, at the points
+    (a, b). Points outside of the grid are left as they are in out. Returns the mask of the points inside"""
+    n = values.shape[0] - 1
+    inside = np.zeros(a.size, dtype=np.bool_)
+    for k in range(a.size):
+        x = (a[k] - lower) / step
+        y = (b[k] - lower) / step
+        if not (0 <= x <= n and 0 <= y <= n):
+            continue
+        i = min(int(x), n - 1)
+        j = min(int(y), n - 1)
+        x -= i
+        y -= j
+        out[k] = (values[i, j] * (1 - x) * (1 - y) + values[i + 1, j] * x * (1 - y) +
+                  values[i, j + 1] * (1 - x) * y + values[i + 1, j + 1] * x * y)
+        inside[k] = True
+    return inside
+
+
+class PreisachFGrid:
+    """F function of the Preisach model tabulated on a square (alpha, beta) grid and evaluated by bilinear
+    interpolation. Points outside of the grid are evaluated with the original function.
+
+    Args:
+        F_fun: F function, taking arrays of alphas and betas
+        lower, upper (num): range of the grid in both alpha and beta
+        resolution (int): number of grid points in each direction
+    """
+
+    def __init__(self, F_fun, lower, upper, resolution):
+        assert resolution >= 2, 'The F grid needs at least 2 points in each direction'
+        self.F_fun = F_fun
+        self.lower = float(lower)
+        self.grid = np.linspace(lower, upper, int(resolution))
+        self.step = self.grid[1] - self.grid[0]
+        alpha, beta = np.meshgrid(self.grid, self.grid, indexing='ij')
+        self.values = np.asarray(F_fun(alpha.ravel(), beta.ravel()), dtype=float).reshape(alpha.shape)
+
+    def get_key(self):
+        """The table is set by the function and the grid, so they describe it"""
+        return get_F_key(self.F_fun), self.lower, self.step, self.grid.size
+
+    def __call__(self, a, b):
+        scalar = np.ndim(a) == 0
+        a = np.ascontiguousarray(a, dtype=float).ravel()
+        b = np.ascontiguousarray(b, dtype=float).ravel()
+        out = np.empty(a.size)
+        inside = bilinear_grid(self.lower, self.step, self.values, a, b, out)
+        if not np.all(inside):
+            out[~inside] = self.F_fun(a[~inside], b[~inside])
+        return out[0] if scalar else out
+
+    def get_max_error(self):
+        """Maximum difference from the original function at the centres of the grid cells (where the
+        interpolation is the furthest from the grid points) with alpha >= beta, as used by the Preisach lines"""
+        centres = self.grid[:-1] + self.step / 2
+        alpha, beta = np.meshgrid(centres, centres, indexing='ij')
+        used = alpha >= beta
+        alpha, beta = alpha[used], beta[used]
+        return np.max(np.abs(self(alpha, beta) - self.F_fun(alpha, beta)))
+
+
+def reconstruct_hyst_signal(signal, L_start, F_fun):
+    """Adjust for the hysteresis of the signal given the starting Preisach line
+    and the integral F functions of the Preisach model.
+    The line is updated by compiled code, and F_fun is called once for all the points of the line which changed"""
+    signal = np.ascontiguousarray(signal, dtype=float)
+    L_start = np.ascontiguousarray(L_start, dtype=float)
+    if signal.size == 0:
+        return np.zeros(0), L_start.copy()
+    points, first, lengths, L = hyst_line_points(signal, L_start)
+    F_points = np.asarray(F_fun(points[:, 0], points[:, 1]), dtype=float)
+    return hyst_line_signal(F_points, points[:, 1].copy(), L_start.shape[0], first, lengths), L
+
+
 def filter_signal(t, signal, bin_dt=0.005):
     # to speed up, filter the high frequency stuff
     signal_bin = binned_statistic(t, [t, signal], bins=int(
@@ -79,6 +262,86 @@ def filter_signal(t, signal, bin_dt=0.005):
     return signal_bin[0, :], signal_bin[1, :]
 
 
+class PreisachF:
+    """F function of the Preisach model, from the fits of the main branch and of the transition branches.
+    A class rather than a lambda so that it can be pickled to the processes inverting the poles"""
+
+    def __init__(self, f_a, f_ab):
+        self.f_a = f_a
+        self.f_ab = f_ab
+
+    def __call__(self, a, b):
+        return (self.f_a.__call__(a) - self.f_ab.ev(a, b)) / 2
+
+    def get_key(self):
+        return hashlib.sha1(pickle.dumps((self.f_a, self.f_ab))).hexdigest()
+
+
+def get_F_key(F_fun):
+    """Describes the F function by its contents rather than its identity, so that a rebuilt function has a new key
+    and a copy (e.g. in another process) the same one"""
+    if hasattr(F_fun, 'get_key'):
+        return F_fun.get_key()
+    return hashlib.sha1(pickle.dumps(F_fun)).hexdigest()
+
+
+# calibration used by the pool processes of MagnetHystCalib, set once when the process starts
+worker_calibration = None
+
+
+def init_pole_worker(calibration):
+    global worker_calibration
+    worker_calibration = calibration
+
+
+def invert_pole_worker(t0, pole_signal, pole, repetitions, start_l):
+    return worker_calibration.get_required_input_pole(t0, pole_signal, pole, repetitions=repetitions,
+                                                      start_l=start_l)
+
+
+class PreisachStore:
+    """Directory of inverted pole signals, so that a waveform is only ever inverted once (see MagnetHystCalib.precompute).
+    Every signal is kept in a .npy file named by the hash of everything the inversion depends on: the pole signal and
+    its times, the pole, the repetitions, the kepco mode, the starting Preisach line and the calibration itself
+    (including the contents of the fit file, so a new fit does not get the signals inverted with the old one).
+    The stored signals are exactly the computed ones.
+
+        Args:
+            directory (str): where the signals are kept
+            calibration_key: description of the calibration, added to every key
+    """
+
+    def __init__(self, directory, calibration_key):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        h = hashlib.sha1()
+        hash_update(h, calibration_key)
+        self.calibration_hash = h.hexdigest()
+
+    def key(self, t0, pole_signal, pole, repetitions, kepco_mode, start_l):
+        h = hashlib.sha1(self.calibration_hash.encode())
+        hash_update(h, (np.asarray(t0, dtype=float), np.asarray(pole_signal, dtype=float), pole, repetitions,
+                        kepco_mode, np.asarray(start_l, dtype=float)))
+        return h.hexdigest()
+
+    def get_path(self, key):
+        return os.path.join(self.directory, key + '.npy')
+
+    def load(self, key):
+        """Returns the signal stored under the key, None if there is none"""
+        try:
+            return np.load(self.get_path(key))
+        except (OSError, ValueError):
+            return None
+
+    def save(self, key, signal):
+        # write to a temporary file first, so that a half written file is never read
+        fd, path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as fp:
+            np.save(fp, signal)
+        os.replace(path, self.get_path(key))
+
+
 class MagnetHystCalib(InstrumentCalibration):
     """Rotates the input, inverts magnet core hysteresis  and applies RL circuit response to get the required voltages for the
     desired inputs.
@@ -89,6 +352,15 @@ class MagnetHystCalib(InstrumentCalibration):
 
     Args:
         Parameters: full path to the file containing the calibration parameters. This should be in the data folder.
+            Optionally F_grid_resolution, the number of points in each direction of the grid the F functions are
+            tabulated on (see PreisachFGrid). 0 evaluates the fitted splines directly. The default 401 changes the
+            outputs by up to about 6e-5 compared to the splines
+            Optionally F_grid_tolerance, the largest difference between the grids and the fitted F functions before
+            warning at load time. 1e-4 by default
+            Optionally pool_size, the number of processes inverting the poles in parallel. They are started on the
+            first inversion and kept with the calibration tables loaded. 0 inverts the poles one after another.
+            By default 3 if there are more than 3 cores, 0 otherwise
+            Optionally store_dir, a directory where the inverted pole signals are kept (see PreisachStore)
         Subinstruments: hallprobe, needed for getting the hallprobe calibration to invert to voltages.
     """
 
@@ -103,15 +375,17 @@ class MagnetHystCalib(InstrumentCalibration):
         # remove from parameters so that it doesn't interfere with saving
         del self.parameters['file_path']
         with open(self.file_path, 'rb') as fp:
-            calibration_data = pickle.load(fp)
+            file_contents = fp.read()
+        calibration_data = pickle.loads(file_contents)
+        # the fits can be redone into the same file, so kept results are described by its contents, not its name
+        self.file_hash = hashlib.sha1(file_contents).hexdigest()
 
         # get the major loop fit
         self.main_branch_fits = calibration_data['main_branch']
         # get the minor loops fits
         self.transition_fits = calibration_data['transition_branches']
         # create F_functions of the Preisach model
-        self.F_functions = [lambda a, b, f_a=f_a, f_ab=f_ab: (f_a.__call__(a) - f_ab.ev(a, b)) / 2
-                            for f_a, f_ab in zip(self.main_branch_fits, self.transition_fits)]
+        self.F_functions = [PreisachF(f_a, f_ab) for f_a, f_ab in zip(self.main_branch_fits, self.transition_fits)]
         # list of poles, this is for convenience only
         self.poles = range(3)
         # get the per pole resistance
@@ -127,14 +401,74 @@ class MagnetHystCalib(InstrumentCalibration):
         self.fitting_displacements = calibration_data['fitting_displacements']
         # get the maximum and minimum fields we can apply
         self.pole_mxmn = [self.start_l[pole][0, :] for pole in self.poles]
+        # tabulate the F functions, interpolating on a grid is a lot faster than evaluating the splines
+        self.F_grid_resolution = parameters.get('F_grid_resolution', 401)
+        self.F_grid_tolerance = parameters.get('F_grid_tolerance', 1e-4)
+        self.F_spline_functions = self.F_functions
+        if self.F_grid_resolution:
+            self.F_functions = []
+            for pole in self.poles:
+                lines = np.vstack((self.start_l[pole], self.degauss_l[pole]))
+                self.F_functions.append(PreisachFGrid(self.F_spline_functions[pole], np.min(lines), np.max(lines),
+                                                      self.F_grid_resolution))
+            errors = [F.get_max_error() for F in self.F_functions]
+            if max(errors) > self.F_grid_tolerance:
+                warn('Preisach F grids of {0}x{0} points differ from the fits by up to {1}, increase '
+                     'F_grid_resolution'.format(self.F_grid_resolution, ', '.join('{:.2e}'.format(e) for e in errors)))
+        # processes inverting the poles in parallel, started when first needed. By default only if there are cores
+        # left for the other processes (e.g. NI IO), otherwise it is slower than inverting one pole after another
+        self.pool_size = parameters.get('pool_size', len(self.poles) if (os.cpu_count() or 1) > len(self.poles) else 0)
+        self.pool = None
+        self.pool_state = None
+        # inverted signals kept on disk
+        self.store_dir = parameters.get('store_dir', None)
+        if self.store_dir is None:
+            self.store = None
+        else:
+            self.store = PreisachStore(self.store_dir, (self.file_hash, self.F_grid_resolution, self.R, self.L,
+                                                        self.fitting_displacements, self.cutoff_freq))
+
+    def __getstate__(self):
+        # the pool processes get everything but the hallprobe (its calibration is applied before) and the pool
+        state = self.__dict__.copy()
+        state['hallprobe'] = None
+        state['pool'] = None
+        state['pool_state'] = None
+        return state
+
+    def get_pool_state(self):
+        """Returns a hash of everything the pole inversion depends on. The pool processes got a copy of the
+        calibration when they were started, so the pool is started again when this changes"""
+        h = hashlib.sha1()
+        hash_update(h, (self.file_hash, self.kepco_mode, self.F_grid_resolution, [get_F_key(F) for F in self.F_functions],
+                        self.degauss_l, self.fitting_displacements, self.R, self.L, self.cutoff_freq))
+        return h.hexdigest()
+
+    def get_pool(self):
+        """Returns the pool of processes inverting the poles, starting it if needed"""
+        state = self.get_pool_state()
+        if self.pool is not None and state != self.pool_state:
+            self.shutdown_pool()
+        if self.pool is None:
+            self.pool = ProcessPoolExecutor(max_workers=self.pool_size, initializer=init_pole_worker,
+                                            initargs=(self,))
+            self.pool_state = state
+        return self.pool
 
-    def get_required_input_pole(self, t0, pole_signal, pole, repetitions=2):
+    def shutdown_pool(self):
+        """Stops the processes inverting the poles. They are started again when needed"""
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+
+    def get_required_input_pole(self, t0, pole_signal, pole, repetitions=2, start_l=None):
         """Gets the required hex signal given the measured/desired hp signal for a given pole.
         hp_signal is expected to be nx2 array with first column being time.
+        start_l is the Preisach line the pole starts from, the degauss line if None.
         Returns the hx_signal"""
 
         F_fun = self.F_functions[pole]
-        start_l = self.degauss_l[pole].copy()
+        start_l = (self.degauss_l[pole] if start_l is None else start_l).copy()
         ds = self.fitting_displacements[pole]
 
         # to speed up, filter the high frequency stuff
@@ -183,27 +517,81 @@ class MagnetHystCalib(InstrumentCalibration):
             v_out = np.interp(t0_full, t_nohyst, signal_nohyst)
         return v_out
 
-    def get_required_input(self, t, fields, repetitions=2):
+    def get_required_input(self, t, fields, repetitions=2, start_lines=None):
         """Gets the required hex signal given the measured/desired fields signal for a given pole.
         fields is expected to be nx3 array of the per-pole fields at the given time t.
-        The t and fields array need to be the same length
+        The t and fields array need to be the same length.
+        start_lines are the Preisach lines of the poles to start from, the degauss lines if None.
         Returns the hx_signal in the same shape."""
+        return self.invert_fields(t, fields, repetitions=repetitions, start_lines=start_lines)[0]
+
+    def invert_fields(self, t, fields, repetitions=2, start_lines=None):
+        """Does get_required_input, returns the hx_signal and the list of poles which were not in the store"""
         assert t.size == fields.shape[0]
+        t = np.asarray(t)
+        if start_lines is None:
+            start_lines = self.degauss_l
 
         out_signal = np.zeros((fields.shape[0] * repetitions, fields.shape[1]))
+        # take what was already inverted from the store
+        keys = {}
+        poles = []
         for pole in self.poles:
-            out_signal[:, pole] = self.get_required_input_pole(
-                t, fields[:, pole], pole, repetitions=repetitions)
-        return out_signal
+            if self.store is not None:
+                keys[pole] = self.store.key(t, fields[:, pole], pole, repetitions, self.kepco_mode, start_lines[pole])
+                stored = self.store.load(keys[pole])
+                if stored is not None and stored.shape[0] == out_signal.shape[0]:
+                    out_signal[:, pole] = stored
+                    continue
+            poles.append(pole)
+
+        inverted = False
+        if self.pool_size and len(poles) > 1:
+            # the poles are independent, so they are inverted in parallel
+            try:
+                futures = [self.get_pool().submit(invert_pole_worker, t, fields[:, pole], pole, repetitions,
+                                                  start_lines[pole]) for pole in poles]
+                for pole, future in zip(poles, futures):
+                    out_signal[:, pole] = future.result()
+                inverted = True
+            except BrokenProcessPool:
+                warn('The processes inverting the poles stopped, inverting them one after another')
+                self.shutdown_pool()
+        if not inverted:
+            for pole in poles:
+                out_signal[:, pole] = self.get_required_input_pole(
+                    t, fields[:, pole], pole, repetitions=repetitions, start_l=start_lines[pole])
+        if self.store is not None:
+            for pole in poles:
+                self.store.save(keys[pole], out_signal[:, pole])
+        return out_signal, poles
 
-    def data2inst(self, data, return_setpoint=False, repetitions=2, return_transient=True, **kwargs):
+    def precompute(self, waveforms, repetitions=2, start_lines=None):
+        """Inverts the waveforms (dataframes of fields, as passed to data2inst) into the store, so that outputting
+        them later does not need to invert anything. Needs the store_dir parameter.
+        Returns the number of poles which needed inverting"""
+        assert self.store is not None, 'Precomputing needs a store, set the store_dir parameter'
+        n_inverted = 0
+        for data in waveforms:
+            t, fields = self.get_hallprobe_fields(data)
+            n_inverted += len(self.invert_fields(t, fields, repetitions=repetitions, start_lines=start_lines)[1])
+        return n_inverted
+
+    def get_hallprobe_fields(self, data):
+        """Inverts the hallprobe calibration of the dataframe of fields. Returns the times and the fields in V as
+        numpy arrays. An affine hallprobe calibration (scale and rotation composed into one map, see
+        AffineCalibration) is a single matrix product with its cached inverse"""
+        affine = self.hallprobe.calibration.get_data2inst_affine()
+        if affine is None:
+            data_raw = self.hallprobe.calibration.data2inst(data)
+            return np.asarray(data_raw.index), data_raw.values
+        return np.asarray(data.index), apply_affine(np.array(data, dtype=float), affine)
+
+    def data2inst(self, data, return_setpoint=False, repetitions=2, return_transient=True, start_lines=None, **kwargs):
         if data.shape[0] == 0:
             return data
         # invert hallprobe calibration (to get the fields in V)
-        data_raw = self.hallprobe.calibration.data2inst(data)
-        # get the time and fields for easier handling
-        t = data_raw.index
-        fields = data_raw.values
+        t, fields = self.get_hallprobe_fields(data)
         # quickly check if the demanded fields are too large
         good_fields = self.check_fields(fields)
         if not good_fields:
@@ -211,7 +599,7 @@ class MagnetHystCalib(InstrumentCalibration):
 
         # get the signal to output
         signal_out = self.get_required_input(
-            t, fields, repetitions=repetitions)
+            t, fields, repetitions=repetitions, start_lines=start_lines)
 
         # make sure that the signal is capped by 10:
         if np.any(np.abs(signal_out) > 10):
@@ -240,6 +628,15 @@ class MagnetHystCalib(InstrumentCalibration):
         else:
             return data_out
 
+    def cache_key(self):
+        # the hallprobe calibration is inverted first, so its current matrix is part of the key
+        hallprobe_affine = self.hallprobe.calibration.get_inst2data_affine()
+        if hallprobe_affine is None:
+            return None
+        # the fits are only described by the contents of the file they were loaded from
+        return (self.file_hash, self.kepco_mode, self.parameters, self.degauss_l, self.fitting_displacements,
+                self.R, self.L, self.cutoff_freq, hallprobe_affine)
+
     def check_fields(self, fields):
         """Checks if the asked fields are out of range or not"""
         # check for every pole
@@ -0,0 +1,57 @@
+import numpy as np
+try:
+    from instrumental import Q_
+except (ImportError, OSError):
+    Q_ = None
+from .ni_simulated import SimulatedTask
+
+# types of the minitasks of an instrumental task
+CHANNEL_TYPES = {'AI', 'AO', 'DI', 'DO', 'CI', 'CO'}
+
+
+def get_minitasks(task):
+    """Returns the list of (channel type, minitask) of the task. instrumental keeps the minitasks by channel type,
+    the multi device (RTSI) version by device and then by channel type"""
+    mtasks = task._mtasks
+    if all(isinstance(m, dict) for m in mtasks.values()):
+        pairs = [(ch_type, m) for dev_mtasks in mtasks.values() for ch_type, m in dev_mtasks.items()]
+    else:
+        pairs = list(mtasks.items())
+    if any(ch_type not in CHANNEL_TYPES or isinstance(m, dict) for ch_type, m in pairs):
+        raise RuntimeError('Unexpected layout of the NI task minitasks: {}'.format(mtasks))
+    return pairs
+
+
+def read_block(task, n_samples, timeout=1.):
+    """Reads exactly n_samples from every analog and digital input of the task, on all of its devices.
+
+    The card driver blocks inside the read until the requested number of samples is in its buffer, so the read
+    returns as soon as the block is complete instead of after a fixed sleep. The simulated task has no driver
+    events and polls instead.
+
+    Args:
+        task: instrumental Task or SimulatedTask, already started
+        n_samples (int): number of samples per channel to read
+        timeout (num): maximum time in s to wait for the block
+    Returns:
+        dictionary of port: values, with the time 't' as returned by task.read
+    """
+    if isinstance(task, SimulatedTask):
+        return task.read(timeout=timeout, n_samples=n_samples)
+    inputs = [(ch_type, m) for ch_type, m in get_minitasks(task) if ch_type in {'AI', 'DI'}]
+    if len(inputs) == 0:
+        raise RuntimeError('The NI task has no inputs to read')
+    result = {}
+    for ch_type, mtask in inputs:
+        # every minitask blocks until its block is complete
+        if ch_type == 'AI':
+            data = mtask.read_AI_channels(samples=n_samples, timeout=Q_(timeout, 's'))
+        else:
+            data = mtask.read_DI_channels(samples=n_samples, timeout=Q_(timeout, 's'))
+        data.pop('t', None)
+        result.update(data)
+    # the devices should return the same number of samples, but only keep what all of them have
+    n_read = min(len(v) for v in result.values())
+    result = {port: v[:n_read] for port, v in result.items()}
+    result['t'] = np.arange(n_read) / task.fsamp.m_as('Hz')
+    return result
@@ -0,0 +1,99 @@
+import numpy as np
+
+
+class NIrecordBlock:
+    """Preallocated float64 block the NI chunks are copied into, so that the IO process never builds dataframes.
+
+    The column order is fixed when the block is created, the first column is always the time.
+    The time column is filled from a precomputed vector of time steps instead of calling linspace on every chunk.
+
+    Args:
+        columns (list): labels of the columns, the first one needs to be 't'
+        rate (int): rate of the NI card
+        n_samples (int): number of rows preallocated. The block grows if a bigger chunk arrives
+    """
+
+    def __init__(self, columns, rate, n_samples):
+        assert columns[0] == 't', 'First column of the record needs to be the time'
+        self.columns = list(columns)
+        self.rate = rate
+        self._allocate(int(n_samples))
+
+    def _allocate(self, n_samples):
+        self.block = np.zeros((n_samples, len(self.columns)))
+        self.time_steps = np.arange(n_samples) / self.rate
+
+    def fill(self, chunk, t0):
+        """Copies the chunk into the block and sets the time so that the first sample is at t0.
+
+        Args:
+            chunk (dict): dictionary of label: values as returned by task.read or written with task.write.
+                The time in the chunk (if any) is ignored
+            t0 (num): time of the first sample
+        Returns:
+            view of the filled part of the block. It is overwritten by the next fill, so copy it if you need to keep it
+        """
+        n_samps = len(chunk[self.columns[-1]]) if len(self.columns) > 1 else len(chunk['t'])
+        if n_samps > self.block.shape[0]:
+            self._allocate(2 * n_samps)
+        for i, label in enumerate(self.columns[1:], 1):
+            # remove units if there are any
+            self.block[:n_samps, i] = getattr(chunk[label], 'magnitude', chunk[label])
+        np.add(self.time_steps[:n_samps], t0, out=self.block[:n_samps, 0])
+        return self.block[:n_samps]
+
+
+class NIoutputCursor:
+    """Keeps the waveform of every output port as one contiguous buffer with an integer cursor and hands out the
+    next samples to write in a single preallocated (ports x samples) array.
+
+    Waveforms shorter than the maximum number of samples written at once are tiled (to a whole number of periods),
+    so that every refresh needs at most two copies per port, one on each side of the wrap point.
+
+    Args:
+        output (dict): dictionary of port: waveform which is repeated on the port
+        n_samples (int): maximum number of samples handed out at once
+    """
+
+    def __init__(self, output, n_samples):
+        self.ports = list(output.keys())
+        self.n_samples = int(n_samples)
+        self.out = np.zeros((len(self.ports), self.n_samples))
+        self.buffers = [None] * len(self.ports)
+        self.periods = [1] * len(self.ports)
+        self.cursors = [0] * len(self.ports)
+        self.set_output(output, reset_ports=self.ports)
+
+    def set_output(self, output, reset_ports=()):
+        """Replaces the waveforms of the ports in output. Ports in reset_ports start from the beginning of the
+        new waveform, the others continue from the same index (wrapped to the new waveform length)"""
+        for i, port in enumerate(self.ports):
+            if port not in output:
+                continue
+            waveform = np.asarray(output[port], dtype=float)
+            period = waveform.size
+            if port in reset_ports:
+                cursor = 0
+            else:
+                cursor = (self.cursors[i] % self.periods[i]) % period
+            if period < self.n_samples:
+                waveform = np.tile(waveform, int(np.ceil(self.n_samples / period)))
+            self.buffers[i] = waveform
+            self.periods[i] = period
+            self.cursors[i] = cursor
+
+    def next(self, n_samps):
+        """Returns a dictionary of port: next n_samps samples of the port. The arrays are views into the
+        preallocated output array, which is overwritten on the next call"""
+        assert n_samps <= self.n_samples, 'Can not hand out more samples than preallocated'
+        for i, buffer in enumerate(self.buffers):
+            start = self.cursors[i]
+            end = start + n_samps
+            if end <= buffer.size:
+                self.out[i, :n_samps] = buffer[start:end]
+            else:
+                delta = buffer.size - start
+                self.out[i, :delta] = buffer[start:]
+                self.out[i, delta:n_samps] = buffer[:n_samps - delta]
+            self.cursors[i] = end % buffer.size
+        return {port: self.out[i, :n_samps] for i, port in enumerate(self.ports)}
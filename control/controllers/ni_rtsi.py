@@ -3,11 +3,21 @@ import signal
 import os
 import threading
 import multiprocessing as mp
+import queue
 import time
 import numpy as np
 import pandas as pd
-from instrumental.drivers.daq.ni import NIDAQ, Task
 import traceback
+from functools import partial
+try:
+    from instrumental.drivers.daq.ni import NIDAQ, Task
+except (ImportError, OSError):
+    # no NI drivers on this machine, only the simulated card can be used
+    NIDAQ, Task = None, None
+from .ni_shared_memory import NIsharedRing, SharedRingSender, pack_output, unpack_output, close_output
+from .ni_records import NIrecordBlock, NIoutputCursor
+from .ni_simulated import SimulatedNIDAQ, SimulatedTask
+from .ni_acquisition import read_block
 
 
 class NIcardRTSI:
@@ -24,10 +34,27 @@ class NIcardRTSI:
         output_signal (dict): data that is currently being outputted
         output_ports (list): list of output ports/5  from ports)
         input_ports (list): list of input ports (derived from ports)
+        transport (str): how the data gets from the IO process to the instruments. "queue" pickles every chunk
+            through a multiprocessing queue per instrument, "shared_memory" writes the chunks into shared memory
+            rings (one for inputs, one for outputs) which the instruments read from
+        shared_memory_time (num): how many seconds of data the shared memory rings keep. Only needs to cover
+            the longest time an instrument might not be reading
+        simulation (dict): if given, the card is replaced by a simulated one with these settings
+            (see SimulatedTask). Useful for running everything without the hardware
+        acquisition (str): how the inputs are read. "polling" reads whatever was acquired every
+            data_acquisition_period, "event" waits in the driver for blocks of data_acquisition_period * rate
+            samples and passes them on as soon as they are complete
+        persistent_worker (bool): if True, the IO process is spawned once and kept between runs of the card, so that
+            stop and start only stop and start the card task. Needs to be closed with quit_worker (or __exit__)
     """
 
+    # waveforms with more samples than this are passed to the IO process through shared memory instead of the pipe
+    shared_waveform_samples = 100000
+
     def __init__(self, ports, name='', rate=10000, data_acquisition_period=0.005,
-                 input_buffer_size=100000, output_refresh_time=0.1):
+                 input_buffer_size=100000, output_refresh_time=0.1,
+                 transport='queue', shared_memory_time=5, simulation=None, acquisition='polling',
+                 persistent_worker=False):
         # name of the controller
         self.name = name
         # rate of NI card
@@ -53,6 +80,10 @@ class NIcardRTSI:
         # staged data is the data that is going to be written to the outputs when the run starts or is updated.
         self.staged_signal = {out: np.zeros(self.output_refresh_samples) for out in
                               self.ports['AO']}
+        # ports staged since the last output change, only these are sent to the IO process
+        self.changed_ports = set()
+        # sample index at which the last output change took effect
+        self.output_switch_index = None
         # set of events for resetting the index of NI output
         self.index_reset = {out: mp.Event()
                             for out in self.ports['AO']}
@@ -86,9 +117,32 @@ class NIcardRTSI:
         self.IO_process = mp.Process()
         self.IO_process.daemon = False
 
+        # the persistent worker gets its commands through the connection and sets IO_running while the card runs
+        self.persistent_worker = persistent_worker
+        self.worker_connection, self.worker_end = mp.Pipe()
+        self.IO_running = mp.Event()
+        # number of queues the worker was spawned with
+        self.worker_queue_count = 0
+
         # list of ni queues for reading the NI data
         self.queue_list = []
 
+        # settings of the simulated card, None uses the real one
+        self.simulation = simulation
+
+        assert acquisition in {'polling', 'event'}, 'Acquisition needs to be polling or event'
+        self.acquisition = acquisition
+
+        # shared memory rings replace the queues if that transport is chosen
+        assert transport in {'queue', 'shared_memory'}, 'Transport needs to be queue or shared_memory'
+        self.transport = transport
+        self.shared_rings = None
+        if transport == 'shared_memory':
+            ring_samples = int(np.round(shared_memory_time * rate))
+            self.shared_rings = {
+                'input': NIsharedRing(['t'] + self.ports['AI'] + self.ports['DI'], ring_samples),
+                'output': NIsharedRing(['t'] + list(self.staged_signal.keys()), ring_samples)}
+
     @property
     def output_refresh_samples(self):
         """Number of samples that are written on every refresh"""
@@ -96,21 +150,82 @@ class NIcardRTSI:
 
     def start(self):
         """Starts the IO process using the staged signal as the output."""
-        assert not self.IO_process.is_alive(), 'IO process already running!'
+        assert not self.is_running(), 'IO process already running!'
 
         self.IO_shutdown.clear()
+        # the process gets the whole staged signal
+        self.changed_ports.clear()
+
+        if self.persistent_worker:
+            self.start_worker()
+            self.output_signal = self.staged_signal
+            return
 
         # create and start IO process
         self.IO_process = mp.Process(target=run_ni_IO, args=(
             self.staged_signal, self.ports, self.output_reader, self.index_reset, self.IO_shutdown, self.queue_list, self.output_sync_sender,
             self.feedback_senders, self.feedback_receivers, self.update_feedback_reader,
-            self.rate, self.data_acquisition_period, self.input_buffer_size, self.output_refresh_time))
+            self.rate, self.data_acquisition_period, self.input_buffer_size, self.output_refresh_time),
+            kwargs=dict(shared_rings=self.shared_rings, simulation=self.simulation, acquisition=self.acquisition))
         self.IO_process.daemon = False
         self.IO_process.start()
 
         # update the output signal
         self.output_signal = self.staged_signal
 
+    def get_session_settings(self):
+        """Settings of the card which can change between runs without respawning the persistent worker"""
+        return dict(rate=self.rate, data_acquisition_period=self.data_acquisition_period,
+                    input_buffer_size=self.input_buffer_size, output_refresh_period=self.output_refresh_time)
+
+    def reconfigure(self, **settings):
+        """Changes the settings of the card (rate, data_acquisition_period, input_buffer_size, output_refresh_time).
+        If the card is running, it is restarted with the new settings, without respawning the persistent worker"""
+        for key in settings:
+            assert key in {'rate', 'data_acquisition_period', 'input_buffer_size', 'output_refresh_time'}, \
+                'Setting {} can not be reconfigured'.format(key)
+        running = self.is_running()
+        if running:
+            self.stop()
+        for key, value in settings.items():
+            setattr(self, key, value)
+        if running:
+            self.start()
+
+    def start_worker(self):
+        """Starts a run of the card on the persistent worker, spawning the worker first if needed"""
+        # queues can only be given to a process when it is spawned, so respawn if any were added since
+        if self.IO_process.is_alive() and self.worker_queue_count != len(self.queue_list):
+            self.quit_worker()
+        if not self.IO_process.is_alive():
+            self.IO_process = mp.Process(target=run_ni_IO_worker, args=(
+                self.worker_end, self.IO_running, self.ports, self.output_reader, self.index_reset, self.IO_shutdown,
+                self.queue_list, self.output_sync_sender, self.feedback_senders, self.feedback_receivers,
+                self.update_feedback_reader),
+                kwargs=dict(shared_rings=self.shared_rings, simulation=self.simulation, acquisition=self.acquisition))
+            self.IO_process.daemon = False
+            self.IO_process.start()
+            self.worker_queue_count = len(self.queue_list)
+        self.worker_connection.send(('start', self.staged_signal, self.get_session_settings()))
+        self.wait_for_worker('started')
+
+    def wait_for_worker(self, reply):
+        """Waits for the given reply of the persistent worker, skipping older replies"""
+        while True:
+            if self.worker_connection.poll(0.1):
+                if self.worker_connection.recv() == reply:
+                    return
+            elif not self.IO_process.is_alive():
+                raise RuntimeError('The NI IO worker process died')
+
+    def quit_worker(self):
+        """Stops the card and ends the persistent worker process"""
+        self.stop()
+        if self.IO_process.is_alive():
+            self.worker_connection.send(('quit',))
+            self.wait_for_worker('quit')
+            self.IO_process.join()
+
     def add_queue(self, p):
         # check that it all makes sense, otherwise will crash the whole thing
         if p.type == 'AO':
@@ -119,6 +234,8 @@ class NIcardRTSI:
             assert all(pn in self.ports[p.type] for pn in p.ports.keys())
 
         self.queue_list.append(p)
+        if self.shared_rings is not None:
+            p.attach_ring(self.shared_rings['output' if p.type == 'AO' else 'input'])
 
     # def add_feedback_sender(self, name, ports):
     #     """Creates a pipe, adds writer to the list of feedback senders and returns the reader"""
@@ -154,6 +271,7 @@ class NIcardRTSI:
             for port in to_stage:
                 if port in self.ports['AO']:
                     self.staged_signal[port] = to_stage[port]
+                    self.changed_ports.add(port)
                 else:
                     raise ValueError(
                         'The port {} not one of the defined output channels'.format(port))
@@ -164,25 +282,40 @@ class NIcardRTSI:
             raise ValueError('to_stage needs to be a dictionary')
 
     def change_output(self):
-        """Updates the output of the currently running signal"""
-        assert self.IO_process.is_alive(), "The task needs to be running"
-        output = self.staged_signal
+        """Updates the output of the currently running signal. Only the ports staged since the last change are sent,
+        long waveforms through shared memory. Returns the time at which the new output starts, the exact sample
+        index is saved in output_switch_index"""
+        assert self.is_running(), "The task needs to be running"
+        output = pack_output({port: self.staged_signal[port] for port in self.changed_ports},
+                             self.shared_waveform_samples)
         # # update the feedbacks
         # self.update_feedback_writer.send(
         #     {key: fr[0] for key, fr in self.feedback_receivers.items()})
-        self.output_writer.send(output)
-        start_time = self.output_sync_reader.recv()
+        try:
+            self.output_writer.send(output)
+            # the IO process acknowledges once it copied the new output
+            start_time, self.output_switch_index = self.output_sync_reader.recv()
+        finally:
+            close_output(output)
+        self.changed_ports.clear()
         self.output_signal = self.staged_signal
         return start_time
 
     def stop(self):
         """Stops and zeros all outputs"""
-        if self.IO_process.is_alive():
+        if self.persistent_worker:
+            # the worker replies once the outputs are zeroed
+            if self.is_running():
+                self.IO_shutdown.set()
+                self.wait_for_worker('stopped')
+        elif self.IO_process.is_alive():
             self.IO_shutdown.set()
             self.IO_process.join()
 
     def is_running(self):
         """Returns true if IO process running"""
+        if self.persistent_worker:
+            return self.IO_process.is_alive() and self.IO_running.is_set()
         return self.IO_process.is_alive()
 
     def __enter__(self):
@@ -190,32 +323,190 @@ class NIcardRTSI:
         return self
 
     def __exit__(self, *args):
-        if self.IO_process.is_alive():
+        if self.persistent_worker:
+            self.quit_worker()
+        elif self.IO_process.is_alive():
             self.stop()
+        if self.shared_rings is not None:
+            for ring in self.shared_rings.values():
+                ring.close()
+            self.shared_rings = None
 
 
 class NIqueue():
-    def __init__(self, ports, port_type):
-        """ports are a list of ports queue addresses, type is the type of ports (AO, AI, DI)"""
-        self.queue = mp.Queue()
+    # statistics kept for every queue. The sent/dropped ones and the max depth are written by the IO process
+    # (for the shared memory transport by the reader), the delivered ones and latencies by the reading instrument
+    stat_names = ['chunks_sent', 'samples_sent', 'chunks_dropped', 'samples_dropped', 'max_depth',
+                  'chunks_delivered', 'samples_delivered', 'last_latency', 'max_latency', 'total_latency']
+
+    def __init__(self, ports, port_type, maxsize=0, policy='drop_oldest'):
+        """ports are a list of ports queue addresses, type is the type of ports (AO, AI, DI)
+
+        maxsize is the maximum number of chunks in the queue (0 is unbounded). What happens when the queue is
+        full is set by the policy: "drop_oldest" throws away the oldest chunk, "block" makes the IO process wait
+        for the reader (for up to a second, then drops the oldest chunk) and "coalesce" keeps the chunks in the IO process and sends them as one once there is space.
+        The coalesce policy keeps at most maxsize chunks in the IO process, past that the oldest are dropped.
+        With the shared memory transport the ring always drops the oldest data and these are ignored.
+        """
+        assert policy in {'drop_oldest', 'block', 'coalesce'}, 'Unknown queue policy {}'.format(policy)
+        self.queue = mp.Queue(maxsize)
+        self.maxsize = maxsize
+        self.policy = policy
         self.ports = ports
         self.type = port_type
         self.send_labels = ['t'] + list(self.ports.keys())
+        self.stats = mp.Array('d', len(self.stat_names), lock=False)
+        # chunks (data, read_time) waiting in the IO process to be coalesced with the next one
+        self.pending = []
+        # time the last received chunk was read from the card (perf_counter)
+        self.last_read_time = None
+        # shared memory ring to read from instead of the queue (attached by the controller)
+        self.ring = None
+        self.ring_columns = None
+        self.ring_cursor = 0
+
+    def attach_ring(self, ring):
+        """Reads the data from the shared memory ring from now on"""
+        self.ring = ring
+        indices = [ring.columns.index(l) for l in self.send_labels]
+        # a contiguous block of columns is copied out of the ring without indexing
+        if indices == list(range(indices[0], indices[0] + len(indices))):
+            self.ring_columns = slice(indices[0], indices[-1] + 1)
+        else:
+            self.ring_columns = np.array(indices)
+        self.ring_cursor = ring.cursor
+
+    def _add_stat(self, name, value):
+        self.stats[self.stat_names.index(name)] += value
+
+    def _max_stat(self, name, value):
+        i = self.stat_names.index(name)
+        self.stats[i] = max(self.stats[i], value)
+
+    def _drop(self, data):
+        self._add_stat('chunks_dropped', 1)
+        self._add_stat('samples_dropped', data.shape[0])
+
+    def put(self, data, read_time):
+        """Sends the chunk following the queue policy. Called by the IO process, never blocks it for long"""
+        if self.policy == 'coalesce':
+            self.pending.append((data, read_time))
+            # the reader stalls, do not keep more than maxsize chunks in the IO process either
+            while len(self.pending) > max(self.maxsize, 1):
+                self._drop(self.pending.pop(0)[0])
+            # only stack the chunks once they can be sent
+            if len(self.pending) > 1 and self.queue.full():
+                return
+            data = np.vstack([d for d, _ in self.pending]) if len(self.pending) > 1 else data
+            read_time = self.pending[0][1]
+            try:
+                self.queue.put((data, read_time), block=False)
+            except queue.Full:
+                return
+            self.pending = []
+        else:
+            try:
+                if self.policy == 'block':
+                    # do not wait forever, so that a reader which stopped reading can not hang the IO process
+                    self.queue.put((data, read_time), block=True, timeout=1)
+                else:
+                    self.queue.put((data, read_time), block=False)
+            except queue.Full:
+                # drop the oldest chunk to make space. The reader might have emptied the queue in the meantime,
+                # or the oldest chunks might not have reached the pipe yet
+                try:
+                    self._drop(self.queue.get(block=False)[0])
+                except queue.Empty:
+                    pass
+                try:
+                    self.queue.put((data, read_time), block=False)
+                except queue.Full:
+                    self._drop(data)
+                    return
+        self._add_stat('chunks_sent', 1)
+        self._add_stat('samples_sent', data.shape[0])
+        try:
+            self._max_stat('max_depth', self.queue.qsize())
+        except NotImplementedError:
+            pass
+
+    def get(self):
+        """Blocks until there is new data and returns it as a numpy array with the columns in send_labels.
+        With the shared memory transport the new rows are copied once out of the ring (see NIsharedRing.read).
+        Returns None once the shared memory ring is closed"""
+        if self.ring is None:
+            data, self.last_read_time = self.queue.get(block=True)
+            return data
+        while True:
+            self.ring.wait(self.ring_cursor, timeout=1)
+            if self.ring.closed:
+                return None
+            data, cursor, lost = self.ring.read(
+                self.ring_cursor, self.ring_columns)
+            # the reader does the bookkeeping of the ring transport, depth is in samples
+            self._max_stat('max_depth', cursor - self.ring_cursor)
+            self.ring_cursor = cursor
+            if lost > 0:
+                self._add_stat('chunks_dropped', 1)
+                self._add_stat('samples_dropped', lost)
+            if data.shape[0] != 0:
+                self._add_stat('chunks_sent', 1)
+                self._add_stat('samples_sent', data.shape[0] + lost)
+                write_time = self.ring.write_time
+                if write_time is not None:
+                    self.last_read_time = write_time
+                return data
+
+    def delivered(self, n_samples):
+        """Called by the reader once the last chunk got to its memory, updates the delivery statistics"""
+        self._add_stat('chunks_delivered', 1)
+        self._add_stat('samples_delivered', n_samples)
+        if self.last_read_time is not None:
+            latency = time.perf_counter() - self.last_read_time
+            self.stats[self.stat_names.index('last_latency')] = latency
+            self._max_stat('max_latency', latency)
+            self._add_stat('total_latency', latency)
+
+    def get_stats(self):
+        """Returns a dictionary of the queue statistics. Latencies are in seconds, from reading the card to
+        getting to the instrument memory"""
+        stats = dict(zip(self.stat_names, self.stats[:]))
+        n_delivered = max(stats['chunks_delivered'], 1)
+        stats['mean_latency'] = stats.pop('total_latency') / n_delivered
+        return stats
 
 
 class QueueListSender:
-    def __init__(self, queue_list):
-        self.queue_list = queue_list
-        self.queue_list_lock = threading.Lock()
+    def __init__(self, queue_list, columns):
+        """columns are the labels of the columns of the numpy chunks which are going to be sent.
 
-    def send(self, result):
-        # send the acquired data to the data queue
-        self.queue_list_lock.acquire(True)
+        The queue list does not change while the IO process runs, so the columns every queue needs are looked up
+        once here. Queues reading a contiguous block of columns get a slice, the others a single take.
+        """
+        self.queue_list = queue_list
+        self.columns = list(columns)
+        self.routes = []
         for q in self.queue_list:
-            if set(q.ports.keys()).issubset(set(result.columns)):
-                data = result[q.send_labels].values
-                q.queue.put(data)
-        self.queue_list_lock.release()
+            if not set(q.send_labels).issubset(self.columns):
+                continue
+            indices = [self.columns.index(l) for l in q.send_labels]
+            if indices == list(range(indices[0], indices[0] + len(indices))):
+                self.routes.append((q, slice(indices[0], indices[-1] + 1)))
+            else:
+                self.routes.append((q, np.array(indices)))
+
+    def send(self, result, read_time=None):
+        """Sends the chunk to all queues reading from it. read_time is when it was read from the card"""
+        if read_time is None:
+            read_time = time.perf_counter()
+        for q, columns in self.routes:
+            # the queue pickles the data in a background thread and the chunk gets overwritten by the next read,
+            # so every queue needs its own copy
+            if isinstance(columns, slice):
+                data = result[:, columns].copy()
+            else:
+                data = np.take(result, columns, axis=1)
+            q.put(data, read_time)
 
 
 def is_output(port):
@@ -227,37 +518,45 @@ def is_output(port):
     raise ValueError('The given string is not a port')
 
 
-def ni_read(task, data_acquisition_period, shutdown, data_sender, feedback_senders):
+def ni_read(task, data_acquisition_period, shutdown, data_sender, feedback_senders, block_samples=None):
     """
     Need to document this
     Args:
         feedback_senders: a list of tuples where the first entry is the list of ports and the second
         the writer pipe through which to send the feedback data
+        block_samples: if given, the inputs are read in blocks of this many samples, waiting in the driver
+        until each block is acquired. Otherwise everything acquired is read every data_acquisition_period
     """
     rate = int(np.array(task.fsamp.magnitude))
     last_time = -1 / rate
+    # block the read data is copied into, with columns in the order the data sender expects
+    record = NIrecordBlock(data_sender.columns, rate, rate if block_samples is None else block_samples)
+    block_timeout = None if block_samples is None else max(1., 10 * block_samples / rate)
     try:
         while not shutdown.is_set():
             # read the inputs
-            result = task.read(timeout='1s')
-            # turn the result to np array
-            result = pd.DataFrame.from_dict(
-                {key: value for key, value in result.items()})
+            if block_samples is None:
+                result = task.read(timeout='1s')
+            else:
+                result = read_block(task, block_samples, block_timeout)
+            read_time = time.perf_counter()
             # if nothing was picked up, just continue
-            if result.shape[0] == 0:
+            if len(result['t']) == 0:
                 continue
-            result["t"] += last_time + 1 / rate
+            # turn the result to np array
+            result = record.fill(result, last_time + 1 / rate)
 
-            last_time = result['t'].iloc[-1]
+            last_time = result[-1, 0]
             # send the results
-            data_sender.send(result)
+            data_sender.send(result, read_time)
             # # send the feedback
             # for fs in feedback_senders.values():
             #     feedback_data = result.loc[:, fs[0]].iloc[-1, :]
             #     fs[1].send((last_time, feedback_data))
 
-            # wait for the next bit of data
-            time.sleep(data_acquisition_period)
+            # wait for the next bit of data, in the event mode the read itself waits
+            if block_samples is None:
+                time.sleep(data_acquisition_period)
     except BrokenPipeError:
         pass
     except:
@@ -269,15 +568,6 @@ def ni_read(task, data_acquisition_period, shutdown, data_sender, feedback_sende
             traceback.print_exc()
 
 
-def format_out(out, t, n_samps, rate):
-    # remove units
-    out = {key: np.array(v) for key, v in out.items()}
-    # add time
-    out["t"] = np.linspace(t, t + (n_samps - 1) / rate, n_samps)
-    # get to dataframe
-    to_send = pd.DataFrame.from_dict(out)
-    return to_send
-
 # #TODO: make this work
 # def out_feedback(feedback_controllers, feedback_readers, update_feedback_reader, feedback_time, ):
 #     # this is to prepare the loop
@@ -334,53 +624,59 @@ def format_out(out, t, n_samps, rate):
 
 
 def ni_write(output, task, reader, index_reset, output_refresh_samples, shutdown,
-             data_sender, sync_sender, feedback_receivers, update_feedback_reader):
+             data_sender, sync_sender, feedback_receivers, update_feedback_reader, started=None):
     """Need to doc this!
-    For now, output_sync_sender gives the exact time of the start of the outputs. This is important to have good timing!
+    For now, output_sync_sender gives the exact time and sample index of the start of the outputs. This is important to have good timing!
+    The reader only gets the ports which changed, long waveforms as shared memory handles (see pack_output).
 
     Feedback receivers is a list of tuples, the first element of which is the feedback_controller class, and the second element is the pipe receiver from the reader task.
     I am not sure if this is done in the best or clearest way, so really need to document this
+    The started event (if given) is set once the task is started.
     """
-    start_index = {port: 0 for port in output.keys()}
     n_samps = 2 * output_refresh_samples
-    out = {port: np.take(value, range(start_index[port], start_index[port] + n_samps), mode='wrap') for port, value in
-           output.items()}
-    start_index = {port: value + n_samps for port,
-                   value in start_index.items()}
+    # the cursor keeps track of where in the waveform each port is
+    output_cursor = NIoutputCursor(output, n_samps)
+    out = output_cursor.next(n_samps)
     try:
         rate = int(np.array(task.fsamp.magnitude))
         # start the first output
         task.write(out, autostart=False)
         task.start()
+        if started is not None:
+            started.set()
+        # block the written data is copied into before sending it to the instruments
+        record = NIrecordBlock(data_sender.columns, rate, n_samps)
         t = 0
         # send the acquired data to the data writer
-        to_send = format_out(out, t, n_samps, rate)
-        t = to_send['t'].iloc[-1]
+        to_send = record.fill(out, t)
+        t = to_send[-1, 0]
         data_sender.send(to_send)
+        # number of samples written so far, which is also the index of the next sample
+        n_written = n_samps
         # now start updating the last half of the samples in the buffer
         n_samps = output_refresh_samples
         while not shutdown.is_set():
             # check if there is a new output to receive
             if reader.poll():
-                output = reader.recv()
-                sync_sender.send(t + 1 / rate)
+                output = unpack_output(reader.recv())
+                sync_sender.send((t + 1 / rate, n_written))
                 # reset the appropriate ports
+                reset_ports = []
                 for port in output:
                     if index_reset[port].is_set():
-                        start_index[port] = 0
+                        reset_ports.append(port)
                         index_reset[port].clear()
                     # # reset the feedback
                     # if port in feedback_corrections:
                     #     feedback_corrections[port] = 0
+                output_cursor.set_output(output, reset_ports)
 
-            out = {port: np.take(value, range(start_index[port], start_index[port] + n_samps), mode='wrap') for
-                   port, value in output.items()}
-            start_index = {port: (value + n_samps) % output[port].size for port,
-                           value in start_index.items()}
+            out = output_cursor.next(n_samps)
             task.write(out, autostart=False)
+            n_written += n_samps
             # send the acquired data to the data writer
-            to_send = format_out(out, t + 1 / rate, n_samps, rate)
-            t = to_send['t'].iloc[-1]
+            to_send = record.fill(out, t + 1 / rate)
+            t = to_send[-1, 0]
 
             data_sender.send(to_send)
     except BrokenPipeError:
@@ -394,20 +690,48 @@ def ni_write(output, task, reader, index_reset, output_refresh_samples, shutdown
             traceback.print_exc()
 
 
-def run_ni_IO(output, ports, output_reader, index_reset_event, shutdown_event, queue_list, output_sync_sender, feedback_senders, feedback_receivers, update_feedback_reader,
-              rate=10000, data_acquisition_period=0.005, input_buffer_size=100000, output_refresh_period=0.1, clock_tick_rate=None):
+def ni_IO_session(output, ports, output_reader, index_reset_event, shutdown_event, queue_list, output_sync_sender, feedback_senders, feedback_receivers, update_feedback_reader,
+              rate=10000, data_acquisition_period=0.005, input_buffer_size=100000, output_refresh_period=0.1, clock_tick_rate=None,
+              shared_rings=None, simulation=None, acquisition='polling', daq=None):
+    """Runs the NI card with the given output until the shutdown event is set, then zeros the outputs.
+    daq is a dictionary of device name: NIDAQ objects which is filled in and reused between sessions"""
     # set this process to have a high priority
     process = psutil.Process(os.getpid())
-    process.nice(psutil.HIGH_PRIORITY_CLASS)
+    try:
+        process.nice(psutil.HIGH_PRIORITY_CLASS)
+    except (AttributeError, psutil.AccessDenied):
+        # priority classes only exist on windows
+        pass
     # how many samples need to be added every refresh time
     output_refresh_samples = int(output_refresh_period * rate)
-    # define a queue_list sender
-    data_sender = QueueListSender(queue_list)
+    # size of the blocks read in the event driven acquisition
+    block_samples = None if acquisition == 'polling' else max(1, int(np.round(data_acquisition_period * rate)))
+    # define the senders of the read and written data, either to the queues or to the shared memory rings
+    # the column order of the read and written chunks is fixed here
+    input_columns = ['t'] + ports['AI'] + ports['DI']
+    output_columns = ['t'] + list(output.keys())
+    if shared_rings is None:
+        input_sender = QueueListSender(queue_list, input_columns)
+        output_sender = QueueListSender(queue_list, output_columns)
+    else:
+        input_sender = SharedRingSender(shared_rings['input'], input_columns)
+        output_sender = SharedRingSender(shared_rings['output'], output_columns)
+
+    # use the real or the simulated card
+    if simulation is None:
+        assert NIDAQ is not None, 'NI drivers not found, only the simulated card can be used'
+        daq_class, task_class = NIDAQ, Task
+    else:
+        daq_class, task_class = SimulatedNIDAQ, partial(
+            SimulatedTask, simulation=simulation)
 
     # get the set of devices
     devices = {p.split('/')[0] for p in ports['AI'] +
                ports['AO'] + ports['DI']}
-    daq = {dev: NIDAQ(dev) for dev in devices}
+    daq = {} if daq is None else daq
+    for dev in devices:
+        if dev not in daq:
+            daq[dev] = daq_class(dev)
     # get the set of used ai and ao channels
     channels = [getattr(daq[p.split('/')[0]], p.split('/')[1]) for p in
                 ports['AO'] + ports['AI']]
@@ -418,7 +742,7 @@ def run_ni_IO(output, ports, output_reader, index_reset_event, shutdown_event, q
             int(splitp[2][4:])].as_input())
 
     # define the task with input and output channels
-    task = Task(*channels)
+    task = task_class(*channels)
     # set task timing, the recommended NI number of samples is a tenth of a rate
     task.set_timing(fsamp='{}Hz'.format(rate),
                     n_samples=round(rate / 10), mode='continuous')
@@ -447,13 +771,14 @@ def run_ni_IO(output, ports, output_reader, index_reset_event, shutdown_event, q
     # prepare the reading and output thread
     input_shutdown = threading.Event()
     output_shutdown = threading.Event()
+    output_started = threading.Event()
     input_thread = threading.Thread(target=ni_read, args=(
-        task, data_acquisition_period, input_shutdown, data_sender,
-        feedback_senders))
+        task, data_acquisition_period, input_shutdown, input_sender,
+        feedback_senders, block_samples))
     input_thread.daemon = True
     output_thread = threading.Thread(target=ni_write, args=(
-        output, task, output_reader, index_reset_event, output_refresh_samples, output_shutdown, data_sender,
-        output_sync_sender, feedback_receivers, update_feedback_reader))
+        output, task, output_reader, index_reset_event, output_refresh_samples, output_shutdown, output_sender,
+        output_sync_sender, feedback_receivers, update_feedback_reader, output_started))
     output_thread.daemon = True
 
     run_output = len(ports['AO']) != 0
@@ -465,46 +790,83 @@ def run_ni_IO(output, ports, output_reader, index_reset_event, shutdown_event, q
         else:
             task.start()
 
-        # need a slight delay so that the input tasks definitely starts after the output task
-        time.sleep(0.05)
+        # the input tasks need to start after the output task
+        while run_output and not output_started.wait(0.01) and output_thread.is_alive():
+            pass
 
         # start the acquisiton thread
         if run_input:
             input_thread.start()
 
         # block until ready to quit
-        while not shutdown_event.is_set():
-            time.sleep(0.1)
+        while not shutdown_event.wait(0.1):
             # close if either of the threads is dead and should be alive
             if (not output_thread.is_alive() and run_output) or (not input_thread.is_alive() and run_input):
                 print('One of the threads died! Stopping NI task')
                 shutdown_event.set()
 
     finally:
-        try:
-            # close the threads
-            if output_thread.is_alive():
-                output_shutdown.set()
-                output_thread.join()
-            if input_thread.is_alive():
-                input_shutdown.set()
-                input_thread.join()
+        # close the threads, the reading one is told first so that it does not read after the task is stopped
+        input_shutdown.set()
+        if output_thread.is_alive():
+            output_shutdown.set()
+            output_thread.join()
+        if input_thread.is_alive():
+            input_thread.join()
+        task.unreserve()
+        del task
+        if len(ports['AO']) != 0:
+            # create a task with only output channels
+            channels = [getattr(daq[p.split('/')[0]], p.split('/')[1])
+                        for p in ports['AO']]
+            task = task_class(*channels)
+            # reset outputs to 0
+            task.set_timing(mode='finite')
+            write_data = {out.split(
+                '/')[1]: np.zeros(output_refresh_samples) for out in ports['AO']}
+            # write 0's and stop
+            task.write(write_data, autostart=True)
+            task.wait_until_done()
+            task.stop()
             task.unreserve()
             del task
-            if len(ports['AO']) != 0:
-                # create a task with only output channels
-                channels = [getattr(daq[p.split('/')[0]], p.split('/')[1])
-                            for p in ports['AO']]
-                task = Task(*channels)
-                # reset outputs to 0
-                task.set_timing(mode='finite')
-                write_data = {out.split(
-                    '/')[1]: np.zeros(output_refresh_samples) for out in ports['AO']}
-                # write 0's and stop
-                task.write(write_data, autostart=True)
-                time.sleep(0.1)
-                task.stop()
-                task.unreserve()
-                del task
+
+
+def run_ni_IO(*args, **kwargs):
+    """Runs one IO session (see ni_IO_session) in this process and kills the process once it is over"""
+    try:
+        ni_IO_session(*args, **kwargs)
+    finally:
+        os.kill(os.getpid(), signal.SIGTERM)
+
+
+def run_ni_IO_worker(connection, running, ports, output_reader, index_reset_event, shutdown_event, queue_list,
+                     *args, **kwargs):
+    """Persistent IO process, which keeps the drivers loaded between runs of the card.
+
+    Waits for commands from the controller on the connection: ("start", output, settings) runs an IO session
+    (see ni_IO_session) with the given output and settings (rate, data_acquisition_period, ...) until the shutdown
+    event is set, ("quit",) ends the process. The running event is set while a session runs. The controller gets
+    "started" once the session is starting, "stopped" once the outputs are zeroed and "quit" before exiting.
+    The other arguments are passed to every session.
+    """
+    daq = {}
+    while True:
+        command = connection.recv()
+        if command[0] == 'quit':
+            # do not wait for the instruments to read the rest of the data before exiting
+            for q in queue_list:
+                q.queue.cancel_join_thread()
+            connection.send('quit')
+            break
+        output, settings = command[1], command[2]
+        running.set()
+        connection.send('started')
+        try:
+            ni_IO_session(output, ports, output_reader, index_reset_event, shutdown_event, queue_list,
+                          *args, daq=daq, **kwargs, **settings)
+        except:
+            traceback.print_exc()
         finally:
-            os.kill(os.getpid(), signal.SIGTERM)
+            running.clear()
+            connection.send('stopped')
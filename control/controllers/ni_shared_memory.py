@@ -0,0 +1,240 @@
+import time
+import threading
+import multiprocessing as mp
+from multiprocessing import shared_memory
+import numpy as np
+
+
+class NIsharedRing:
+    """Ring buffer of NI samples living in shared memory, written by the IO process and read by the instruments.
+
+    The first three 8 byte entries of the shared block are the header: the number of rows committed so far
+    (write cursor), the number of rows reserved by the writer (committed + rows currently being written) and the
+    time (perf_counter) the last committed chunk was read from the card. The first two only ever grow,
+    so a reader can tell from them which rows are valid and whether it has been lapped.
+
+    Once closed, wait returns at once and read returns nothing, so the reading threads can stop cleanly.
+
+    Args:
+        columns (list): labels of the columns in the ring. First one is always the time 't'
+        n_samples (int): number of rows kept in the ring
+    """
+    header_size = 3
+
+    def __init__(self, columns, n_samples):
+        self.columns = list(columns)
+        self.n_samples = int(n_samples)
+        assert self.n_samples > 0, 'Shared ring needs to hold at least one sample'
+        # condition used to notify the readers that new data was committed
+        self.new_data = mp.Condition()
+        nbytes = 8 * (self.header_size + self.n_samples * len(self.columns))
+        self.shm = shared_memory.SharedMemory(create=True, size=nbytes)
+        self.owner = True
+        self.closed = False
+        # held by the readers of this process while they use the shared block, so close does not free it under them
+        self.use_lock = threading.Lock()
+        self._map_buffer()
+        self.header[:] = 0
+
+    def _map_buffer(self):
+        self.header = np.ndarray(
+            (self.header_size,), dtype=np.int64, buffer=self.shm.buf)
+        self.write_times = np.ndarray((1,), dtype=float, buffer=self.shm.buf, offset=16)
+        self.data = np.ndarray((self.n_samples, len(self.columns)), dtype=float, buffer=self.shm.buf,
+                               offset=8 * self.header_size)
+
+    def __getstate__(self):
+        # only pass the name of the shared block, the other process attaches to it
+        state = self.__dict__.copy()
+        state['shm'] = self.shm.name
+        state['owner'] = False
+        del state['header']
+        del state['data']
+        del state['write_times']
+        del state['use_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.use_lock = threading.Lock()
+        self.shm = shared_memory.SharedMemory(name=state['shm'])
+        self._map_buffer()
+
+    @property
+    def cursor(self):
+        """Total number of rows committed to the ring"""
+        return int(self.header[0])
+
+    @property
+    def write_time(self):
+        """Time (perf_counter) when the last committed chunk was read from the card, None once closed"""
+        with self.use_lock:
+            if self.closed:
+                return None
+            return float(self.write_times[0])
+
+    def write(self, data, read_time=None):
+        """Copies the 2D array (columns in the order of self.columns) into the ring and moves the write cursor.
+        read_time is when the data was read from the card (now if None). Only the writer process should call this."""
+        n = data.shape[0]
+        if n == 0:
+            return
+        committed = int(self.header[0])
+        reserved = committed + n
+        # if the chunk is longer than the ring, only the latest samples survive
+        if n > self.n_samples:
+            data = data[-self.n_samples:]
+        self.header[1] = reserved
+        start = (reserved - data.shape[0]) % self.n_samples
+        end = start + data.shape[0]
+        if end <= self.n_samples:
+            self.data[start:end] = data
+        else:
+            delta = self.n_samples - start
+            self.data[start:] = data[:delta]
+            self.data[:end - self.n_samples] = data[delta:]
+        self.write_times[0] = time.perf_counter() if read_time is None else read_time
+        self.header[0] = reserved
+        with self.new_data:
+            self.new_data.notify_all()
+
+    def views(self, start, end):
+        """Zero-copy views of the rows with cursors [start, end). Returns a list of up to two arrays.
+        Rows older than the ring length are not available anymore."""
+        start = max(start, end - self.n_samples)
+        if end <= start:
+            return []
+        i0 = start % self.n_samples
+        i1 = i0 + end - start
+        if i1 <= self.n_samples:
+            return [self.data[i0:i1]]
+        return [self.data[i0:], self.data[:i1 - self.n_samples]]
+
+    def read(self, cursor, columns=None):
+        """Copies out the rows written since the cursor. The rows are copied once, straight from the views of the
+        ring into the returned array, which is then checked against the writer like a seqlock: rows the writer
+        overwrote during the copy are cut off and counted as lost. The readers get a copy rather than the views
+        themselves, as the views can be overwritten any time after the check.
+
+        Args:
+            cursor (int): cursor of the first row wanted
+            columns (list or slice): integer indices of the columns to return. A slice of contiguous columns is
+                copied without indexing. None returns all columns
+        Returns:
+            (data, new cursor, number of rows lost because the writer lapped the reader). Nothing once closed
+        """
+        if columns is None:
+            columns = slice(None)
+        n_columns = len(range(len(self.columns))[columns]) if isinstance(columns, slice) else len(columns)
+        with self.use_lock:
+            if self.closed:
+                return np.empty((0, n_columns)), cursor, 0
+            return self._read(cursor, columns, n_columns)
+
+    def _read(self, cursor, columns, n_columns):
+        committed = int(self.header[0])
+        start = max(cursor, committed - self.n_samples)
+        data = np.empty((committed - start, n_columns))
+        i = 0
+        for v in self.views(start, committed):
+            if isinstance(columns, slice):
+                data[i:i + v.shape[0]] = v[:, columns]
+            else:
+                np.take(v, columns, axis=1, out=data[i:i + v.shape[0]])
+            i += v.shape[0]
+        # check that the writer did not overwrite anything while copying
+        overwritten = int(self.header[1]) - self.n_samples
+        if overwritten > start:
+            data = data[overwritten - start:]
+            start = overwritten
+        return data, committed, start - cursor
+
+    def wait(self, cursor, timeout=None):
+        """Blocks until there is data past the cursor or the ring is closed. Returns False on timeout or if closed"""
+        with self.new_data:
+            self.new_data.wait_for(lambda: self.closed or int(self.header[0]) > cursor, timeout=timeout)
+            return not self.closed and int(self.header[0]) > cursor
+
+    def close(self):
+        """Wakes up the waiting readers and detaches from the shared block, the owner also frees it"""
+        # set under the condition, so a waiting reader sees it before it would look at the header again
+        with self.new_data:
+            self.closed = True
+            self.new_data.notify_all()
+        # wait for the readers in the middle of a read
+        with self.use_lock:
+            self.header = None
+            self.data = None
+            self.write_times = None
+            self.shm.close()
+            if self.owner:
+                self.shm.unlink()
+
+
+class SharedRingSender:
+    """Sender with the same interface as QueueListSender which writes the acquired chunks into a shared ring"""
+
+    def __init__(self, ring, columns):
+        assert list(columns) == ring.columns, 'The sent columns need to be in the same order as the ring columns'
+        self.ring = ring
+        self.columns = ring.columns
+
+    def send(self, result, read_time=None):
+        self.ring.write(result, read_time)
+
+
+class NIsharedWaveform:
+    """Waveform copied into a shared memory block, so that only its handle needs to be pickled through the pipe.
+
+    The creating process owns the block and needs to keep the object until the other side has loaded it.
+
+    Args:
+        waveform (np.array): 1D array of the samples
+    """
+
+    def __init__(self, waveform):
+        waveform = np.ascontiguousarray(getattr(waveform, 'magnitude', waveform), dtype=float)
+        self.size = waveform.size
+        self.shm = shared_memory.SharedMemory(create=True, size=max(waveform.nbytes, 8))
+        self.owner = True
+        np.ndarray((self.size,), dtype=float, buffer=self.shm.buf)[:] = waveform
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['shm'] = self.shm.name
+        state['owner'] = False
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.shm = shared_memory.SharedMemory(name=state['shm'])
+
+    def load(self):
+        """Returns a copy of the waveform and detaches from the shared block"""
+        waveform = np.ndarray((self.size,), dtype=float, buffer=self.shm.buf).copy()
+        self.close()
+        return waveform
+
+    def close(self):
+        """Detaches from the shared block, the owner also frees it"""
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+def pack_output(output, min_samples):
+    """Returns a copy of the output dictionary where the waveforms with at least min_samples samples are
+    replaced by NIsharedWaveform handles"""
+    return {port: NIsharedWaveform(w) if np.size(w) >= min_samples else w for port, w in output.items()}
+
+
+def unpack_output(output):
+    """Inverse of pack_output, loads the waveforms from the shared memory handles"""
+    return {port: w.load() if isinstance(w, NIsharedWaveform) else w for port, w in output.items()}
+
+
+def close_output(output):
+    """Frees the shared memory of the handles created by pack_output"""
+    for w in output.values():
+        if isinstance(w, NIsharedWaveform):
+            w.close()
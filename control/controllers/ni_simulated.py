@@ -0,0 +1,227 @@
+import time
+import threading
+import numpy as np
+from scipy.signal import lfilter
+
+
+class SimulatedDAQError(Exception):
+    """Raised by the simulated task where the NI driver would raise an error (e.g. input buffer overflow)"""
+    pass
+
+
+class SimulatedRate(float):
+    """Sampling rate which behaves both like a number and like the pint quantity returned by instrumental"""
+
+    @property
+    def magnitude(self):
+        return float(self)
+
+
+class SimulatedChannel:
+    """Channel of the simulated card. Mimics the channels of the instrumental NIDAQ (including digital lines)"""
+
+    def __init__(self, path):
+        self.path = path
+        self.name = path.split('/')[-1]
+        if self.name[:2] == 'ao':
+            self.type = 'AO'
+        elif self.name[:2] == 'ai':
+            self.type = 'AI'
+        else:
+            self.type = 'DI'
+
+    def __getitem__(self, line):
+        return SimulatedChannel('{}/line{}'.format(self.path, line))
+
+    def as_input(self):
+        return self
+
+
+class SimulatedNIDAQ:
+    """Replaces instrumental NIDAQ, every attribute is a channel of the simulated device"""
+
+    def __init__(self, name):
+        self.name = name
+
+    def __getattr__(self, item):
+        if item.startswith('_'):
+            raise AttributeError(item)
+        return SimulatedChannel('{}/{}'.format(self.name, item))
+
+
+class SimulatedTask:
+    """Simulated NI task with the same interface as the instrumental Task used in run_ni_IO.
+
+    The card runs on wall clock time: after start, samples are produced at fsamp (times time_scale).
+    Writes block while the output buffer is full, reads return all the samples acquired since the last read.
+    Analog outputs can be echoed to analog inputs through a first order low pass filter with a gain and a delay,
+    everything else reads gaussian noise.
+
+    Args:
+        channels: SimulatedChannel objects, as passed to the instrumental Task
+        simulation (dict): simulation settings (all optional)
+            echo (list): list of dicts with keys "output", "input" (port names as in the settings),
+                "gain" (default 1), "time_constant" in s (default 0, no filtering) and "delay" in s (default 0)
+            noise (num): standard deviation of the noise added to the inputs in volts
+            jitter (num): standard deviation of the random delay added to every read and write in seconds
+            overrun_probability (num): probability that a read raises a buffer overflow error
+            input_buffer_size (int): number of unread input samples after which the input buffer overflows
+            time_scale (num): how many virtual seconds pass every real second
+            seed (int): seed of the random generator
+    """
+
+    def __init__(self, *channels, simulation=None):
+        simulation = {} if simulation is None else simulation
+        self.channels = list(channels)
+        self.inputs = [ch.path for ch in self.channels if ch.type != 'AO']
+        self.outputs = [ch.path for ch in self.channels if ch.type == 'AO']
+        # instrumental keeps its per type tasks here, the simulation has none
+        self._mtasks = {}
+        self.noise = simulation.get('noise', 0.)
+        self.jitter = simulation.get('jitter', 0.)
+        self.overrun_probability = simulation.get('overrun_probability', 0.)
+        self.input_buf_size = int(simulation.get('input_buffer_size', 100000))
+        self.time_scale = simulation.get('time_scale', 1.)
+        self.rng = np.random.default_rng(simulation.get('seed', None))
+        self.echo = [e for e in simulation.get('echo', [])
+                     if e['output'] in self.outputs and e['input'] in self.inputs]
+
+        self.fsamp = SimulatedRate(1000.)
+        self.mode = 'continuous'
+        self.running = False
+        self.start_time = None
+        self.n_read = 0
+        # written output samples which have not been generated yet and the size of the output buffer
+        self.output_lock = threading.Lock()
+        self.output_buffer = np.zeros((len(self.outputs), 0))
+        self.n_generated = 0
+        self.output_buf_size = None
+        # last output value of every port, held if the writer does not keep up
+        self.last_output = np.zeros(len(self.outputs))
+        # filter states of the echos, the delay lines hold the samples that have not reached the input yet
+        self.echo_states = [None] * len(self.echo)
+        self.echo_delay_lines = [np.zeros(0)] * len(self.echo)
+
+    def set_timing(self, fsamp=None, n_samples=None, mode='continuous', **kwargs):
+        if fsamp is not None:
+            self.fsamp = SimulatedRate(float(str(fsamp).replace('Hz', '')))
+        self.mode = mode
+
+    def _now_samples(self):
+        """Number of samples the card produced since the start"""
+        return int((time.perf_counter() - self.start_time) * self.time_scale * self.fsamp)
+
+    def _sleep_jitter(self):
+        if self.jitter > 0:
+            time.sleep(abs(self.rng.normal(0, self.jitter)))
+
+    def start(self):
+        self.start_time = time.perf_counter()
+        self.n_read = 0
+        self.n_generated = 0
+        self.running = True
+
+    def stop(self):
+        self.running = False
+
+    def unreserve(self):
+        pass
+
+    def wait_until_done(self, timeout=None):
+        # the simulated outputs are held as soon as they are written
+        pass
+
+    def write(self, data, autostart=True):
+        """Appends the dictionary of port: values to the output buffer, blocking while the buffer is full"""
+        self._sleep_jitter()
+        # the ni controller uses the short port names, the rtsi the full ones
+        values = [data[port] if port in data else data[port.split('/', 1)[1]]
+                  for port in self.outputs]
+        values = np.vstack([np.asarray(getattr(v, 'magnitude', v), dtype=float) for v in values])
+        if len(self.inputs) == 0 and self.running:
+            # nothing reads the generated samples, so discard them here
+            self._generate_outputs(self._now_samples() - self.n_generated)
+        if self.output_buf_size is None:
+            # as on the card, the first write sets the size of the output buffer
+            self.output_buf_size = values.shape[1]
+        if self.running and self.mode == 'continuous':
+            # wait until there is space in the buffer
+            while True:
+                with self.output_lock:
+                    queued = self.output_buffer.shape[1] - \
+                        (self._now_samples() - self.n_generated)
+                if queued + values.shape[1] <= self.output_buf_size or not self.running:
+                    break
+                time.sleep(0.2 * values.shape[1] / self.fsamp / self.time_scale)
+        with self.output_lock:
+            self.output_buffer = np.hstack((self.output_buffer, values))
+        if autostart and not self.running:
+            self.start()
+
+    def _generate_outputs(self, n_samps):
+        """Takes the next n_samps output samples from the buffer. Holds the last value if the writer is too slow"""
+        with self.output_lock:
+            n_available = min(n_samps, self.output_buffer.shape[1])
+            out = np.empty((len(self.outputs), n_samps))
+            out[:, :n_available] = self.output_buffer[:, :n_available]
+            if n_available > 0:
+                self.last_output = out[:, n_available - 1].copy()
+            out[:, n_available:] = self.last_output[:, None]
+            self.output_buffer = self.output_buffer[:, n_available:]
+            self.n_generated += n_samps
+        return out
+
+    def _echo(self, k, signal):
+        """Passes the output signal through the transfer function of the k-th echo"""
+        e = self.echo[k]
+        rate = float(self.fsamp)
+        gain = e.get('gain', 1.)
+        tau = e.get('time_constant', 0.)
+        delay = int(np.round(e.get('delay', 0.) * rate))
+        if tau > 0:
+            alpha = 1 - np.exp(-1 / (rate * tau))
+            b, a = [gain * alpha], [1, alpha - 1]
+            if self.echo_states[k] is None:
+                self.echo_states[k] = np.zeros(1)
+            signal, self.echo_states[k] = lfilter(
+                b, a, signal, zi=self.echo_states[k])
+        else:
+            signal = gain * signal
+        if delay > 0:
+            if self.echo_delay_lines[k].size == 0:
+                self.echo_delay_lines[k] = np.zeros(delay)
+            delayed = np.concatenate((self.echo_delay_lines[k], signal))
+            signal, self.echo_delay_lines[k] = delayed[:-delay], delayed[-delay:]
+        return signal
+
+    def read(self, timeout=None, n_samples=-1):
+        """Returns a dictionary of port: values of all samples acquired since the last read, plus the time 't'.
+
+        If n_samples is given, polls until that many samples were acquired (or the timeout in s passes)
+        and returns only those, as a blocking read of a fixed number of samples on the card would.
+        """
+        self._sleep_jitter()
+        assert self.running, 'Task needs to be started before reading'
+        n_samps = self._now_samples() - self.n_read
+        if n_samples > 0:
+            t_end = None if timeout is None else time.perf_counter() + float(timeout)
+            while n_samps < n_samples and (t_end is None or time.perf_counter() < t_end):
+                time.sleep(min(0.001, (n_samples - n_samps) / self.fsamp / self.time_scale))
+                n_samps = self._now_samples() - self.n_read
+        if n_samps > self.input_buf_size or self.rng.random() < self.overrun_probability:
+            self.running = False
+            raise SimulatedDAQError(
+                'Simulated input buffer overflow: {} samples were not read in time'.format(n_samps))
+        if n_samples > 0:
+            n_samps = min(n_samps, n_samples)
+        rate = float(self.fsamp)
+        result = {port: self.rng.normal(0, self.noise, n_samps) if self.noise > 0 else np.zeros(n_samps)
+                  for port in self.inputs}
+        if len(self.outputs) != 0:
+            outputs = self._generate_outputs(n_samps)
+            for k, e in enumerate(self.echo):
+                result[e['input']] += self._echo(k,
+                                                 outputs[self.outputs.index(e['output'])])
+        result['t'] = (self.n_read + np.arange(n_samps)) / rate
+        self.n_read += n_samps
+        return result
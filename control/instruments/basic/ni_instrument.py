@@ -3,14 +3,62 @@ from control.controllers import *
 import numpy as np
 from ..instrument import Instrument
 from control.exceptions import *
+from control.calibration import apply_affine, CalibrationCache
+from .ni_subsampling import BucketMean, CICDecimator
+from .ni_storage import NIfloatStorage, NIcompactStorage
 from datetime import datetime
 import time
 import warnings
 import traceback
 import threading
+import heapq
 import pandas as pd
 
 
+class NIdataCursor:
+    """Position of an incremental reader in the data stream of an NIinst (see NIinst.get_cursor).
+
+    Every read returns exactly the samples acquired since the previous read, so the consumers do not need to find
+    the new samples by their times (which skipped or repeated samples at the boundaries).
+
+        Args:
+            instrument (NIinst): instrument whose data is read
+            next_sample (int): number of the first sample to return
+    """
+
+    def __init__(self, instrument, next_sample):
+        self.instrument = instrument
+        self.next_sample = next_sample
+
+    def get_new_array(self, min_samples=0):
+        """Returns (data, overrun) where data is a copy of the raw samples acquired since the last read with the time
+        in the 0-th column and overrun is True if some samples were lost since then (overwritten before they were
+        read or from before a restart of the card).
+        If there are less than min_samples new samples, nothing is returned and they are kept for the next read"""
+        inst = self.instrument
+        while True:
+            sequence, data_stream, first, last = inst.get_snapshot()
+            first = max(first, self.next_sample)
+            if last - first < max(min_samples, 1):
+                return np.empty((0, data_stream.n_ports + 1)), False
+            result = data_stream.copy(first, last)
+            # if the writer got to the copied samples in the meantime, try again
+            if inst.is_intact(sequence, first):
+                break
+        overrun = first > self.next_sample
+        self.next_sample = last
+        return result, overrun
+
+    def get_new_data(self, min_samples=0, calibration=None):
+        """Same as get_new_array, but the data is calibrated and returned in a dataframe as by NIinst.get_data"""
+        data, overrun = self.get_new_array(min_samples)
+        inst = self.instrument
+        if (inst.calibration if calibration is None else calibration).get_inst2data_affine() is not None:
+            # affine calibrations are a single matrix multiplication on the copied samples
+            return inst.to_dataframe(inst.calibrate_array(data, calibration)), overrun
+        return inst.calibrate(inst.to_dataframe(data), calibration), overrun
+
+
 class NIinst(Instrument):
     """Class defining instruments connected to the NI card
 
@@ -21,8 +69,16 @@ class NIinst(Instrument):
             type (str): type of an instrument. It can be one of: "analog_input", "analog_output" or "digital_input". Digital outputs not yet supported.
             calibration (function): a handle to a function taking an voltages and outputting physically meaningful values
     """
-
-    def __init__(self, controller, port_type, ports, flushing_time=10, read=True, subsample=1, feedback=None, **kwargs):
+    # how often (in s) wait_for_time checks the stop event. Reaching the time itself wakes the waiting thread up at once
+    stop_check_period = 0.1
+    # maximum number of samples per port of a waveform calibrated over all ports at once (see stage_data).
+    # 10**7 samples are 1000 s at 10 kHz and about 80 MB per port for every copy the calibration makes
+    max_staged_samples = 10 ** 7
+
+    def __init__(self, controller, port_type, ports, flushing_time=10, read=True, subsample=1, feedback=None,
+                 queue_size=1000, queue_policy='drop_oldest', subsample_filter='mean', subsample_order=3,
+                 memmap_threshold=None, memmap_dir=None, storage='float64', storage_range=(-10, 10),
+                 calibration_cache_size=4, calibration_cache_dir=None, **kwargs):
         """Assigns the controller, ports and any of the attributes inherited by the Instrument class
 
             Args:
@@ -31,6 +87,21 @@ class NIinst(Instrument):
                                             in the NIcards object. It is recommended that dictionaries are used for
                                             easier later readability, but this is not a requirement.
                 subsample (int): a number of samples to average over before saving to memory. Smoothens out the data and reduces memory footprint. 1 is no subsampling.
+                subsample_filter (str): how to subsample: "mean" averages every subsample samples (boxcar and decimate),
+                    "cic" uses a cascaded integrator-comb filter of order subsample_order, which aliases less noise
+                    into the kept samples but delays them by subsample_order * (subsample - 1) / 2 samples
+                queue_size (int): maximum number of chunks waiting in the queue from the NI process. 0 is unbounded
+                queue_policy (str): what to do when the queue is full: "drop_oldest", "block" or "coalesce" (see NIqueue)
+                memmap_threshold (int): size in bytes above which the data stream is kept in a memory mapped temporary
+                    file instead of in memory (useful for long flushing times). None always keeps it in memory
+                memmap_dir (str): directory of the memory mapped files. None uses the system temporary directory
+                storage (str): how the samples are kept in memory. "float64" keeps the values and the time of every
+                    sample. "float32" and "int16" (codes over storage_range, clipped outside of it) only keep the
+                    values, the time is implied by the rate (see NIcompactStorage). This takes 2 to 4 times less memory
+                storage_range (tuple): (minimum, maximum) value kept with the int16 storage
+                calibration_cache_size (int): number of calibrated waveforms stage_data keeps, so staging the same
+                    waveform again skips the calibration (see CalibrationCache). 0 turns this off
+                calibration_cache_dir (str): directory where the calibrated waveforms are also kept on disk
                 **kwargs: keyword arguments specified by the Instrument class
         """
         assert isinstance(controller, NIcard) or isinstance(
@@ -63,16 +134,40 @@ class NIinst(Instrument):
         # subsample variable if we want to only preserve the means of every sample (useful for temperature and slow
         #  moving variables
         self.ni_queue = NIqueue(
-            self.ports, self.port_type)
+            self.ports, self.port_type, maxsize=queue_size, policy=queue_policy)
+        # number of dropped chunks we already warned about
+        self.warned_dropped = 0
         # prepare the subsampling variable to reduce the data kept
         self.subsample = int(subsample)
+        assert subsample_filter in {'mean', 'cic'}, 'Unknown subsample filter {}'.format(subsample_filter)
+        if self.subsample == 1:
+            self.subsampler = None
+        elif subsample_filter == 'mean':
+            self.subsampler = BucketMean(self.subsample, len(self.ports) + 1)
+        else:
+            self.subsampler = CICDecimator(self.subsample, len(self.ports) + 1, subsample_order)
         # readjust your rate based on the number of subsamples
         self.rate = self.rate / subsample
 
+        # where to keep big data streams
+        self.memmap_threshold = memmap_threshold
+        self.memmap_dir = memmap_dir
+        # how to keep the samples
+        assert storage in {'float64', 'float32', 'int16'}, 'Unknown storage {}'.format(storage)
+        self.storage = storage
+        self.storage_range = storage_range
+
+        # calibrated waveforms of the last stage_data calls
+        self.calibration_cache = CalibrationCache(calibration_cache_size, calibration_cache_dir)
+
         # prepare the list of times of the data stream
         self.data_times = np.empty([0, 2])
         # prepare the data reading thread, locks and events
         self.data_lock = threading.Lock()
+        # events to set once the data reaches a time, as a heap of (time, subscription number, event)
+        self.time_subscriptions = []
+        self.n_subscriptions = 0
+        self.subscription_lock = threading.Lock()
         self.update_data_thread = threading.Thread(
             target=self.update_data_worker)
         self.update_data_thread.daemon = True
@@ -104,7 +199,17 @@ class NIinst(Instrument):
     def flushing_time(self, value):
         self.set_flushing_time(value)
 
+    def allocate_data_stream(self, n_samples):
+        """Returns an empty data stream (NIfloatStorage or NIcompactStorage, depending on the storage) of n_samples"""
+        kwargs = dict(memmap_threshold=self.memmap_threshold, memmap_dir=self.memmap_dir,
+                      prefix='ni_' + str(self.name) + '_')
+        if self.storage == 'float64':
+            return NIfloatStorage(n_samples, len(self.ports), self.rate, **kwargs)
+        return NIcompactStorage(n_samples, len(self.ports), self.rate, dtype=self.storage,
+                                value_range=self.storage_range, **kwargs)
+
     def set_flushing_time(self, value):
+        # the writer waits on the lock, the readers see the odd resize sequence and wait for the resize to finish
         self.data_lock.acquire(True)
         # if we are setting for the first time, just define the attributes.
         # Otherwise, keep the current data stream and copy to a new length
@@ -112,157 +217,239 @@ class NIinst(Instrument):
             # create new data stream
             self.samples_in_memory = int(
                 np.round(value * self.rate))
-            self.data_stream = np.zeros(
-                (self.samples_in_memory, len(self.ports) + 1)).astype(float)
+            self.data_stream = self.allocate_data_stream(self.samples_in_memory)
             self.final_data_indx = -1
+            # total number of samples written to the data stream, sample n is at index n % samples_in_memory
+            self.samples_written = 0
+            # samples written plus the ones being written, anything older than samples_reserved - samples_in_memory
+            # might be overwritten
+            self.samples_reserved = 0
+            # the time resets when the card restarts, this is the first sample of the current (increasing) time run
+            self.run_start = 0
+            # odd while the data stream is being resized
+            self.resize_sequence = 0
         else:
-            old_samples_in_memory = self.samples_in_memory
-            # get the old data stream
-            start_data_indx = (self.final_data_indx +
-                               1) % old_samples_in_memory
-            if start_data_indx <= self.final_data_indx:
-                old_data_stream = self.data_stream[start_data_indx:self.final_data_indx + 1, :]
-            else:
-                old_data_stream = np.vstack((self.data_stream[start_data_indx:, :],
-                                             self.data_stream[:self.final_data_indx + 1, :]))
-
-            # create the new data stream and keep the old data
+            self.resize_sequence += 1
+            old_data_stream = self.data_stream
+            # create the new data stream and copy the latest old samples which fit, block by block.
+            # Sample n stays sample n (now at index n % samples_in_memory), so cursors stay valid
             self.samples_in_memory = int(
                 np.round(value * self.rate))
-            # create the new data stream, but keep the old data
-            self.data_stream = np.zeros(
-                (self.samples_in_memory, len(self.ports) + 1)).astype(float)
-            if old_samples_in_memory >= self.samples_in_memory:
-                self.data_stream = old_data_stream[-self.samples_in_memory:]
-                self.final_data_indx = self.samples_in_memory - 1
-            else:
-                self.data_stream[:old_samples_in_memory] = old_data_stream
-                self.final_data_indx = old_samples_in_memory - 1
+            self.data_stream = self.allocate_data_stream(self.samples_in_memory)
+            n = max(self.samples_written - min(old_data_stream.n_samples, self.samples_in_memory), 0)
+            self.data_stream.copy_from(old_data_stream, n, self.samples_written)
+            # the samples before the copied ones are not kept anymore
+            self.run_start = max(self.run_start, n)
+            self.final_data_indx = (self.samples_written - 1) % self.samples_in_memory
+            self.samples_reserved = self.samples_written
+            self.resize_sequence += 1
         self.data_lock.release()
         self._flushing_time = value
 
     def update_data_worker(self):
         try:
-            result_leftover = np.empty((0, len(self.ports) + 1))
             while not self.stop_data_thread.is_set():
                 # get the data from the queue (should be in numpy format)
-                result = self.ni_queue.queue.get(block=True)
+                result = self.ni_queue.get()
+                if result is None:
+                    # the controller closed the transport
+                    break
+                n_received = result.shape[0]
+
+                # subsample if needed, outside of the lock. Leftover samples are kept in the subsampler
+                if self.subsampler is not None:
+                    result = self.subsampler.process(result)
+                    if result.shape[0] == 0:
+                        self.ni_queue.delivered(n_received)
+                        continue
 
+                # the lock only keeps the data stream from being resized, the readers do not take it
                 self.data_lock.acquire(True)
-                # subsample if needed
-                if self.subsample != 1:
-                    result = np.vstack((result_leftover, result))
-                    n_take = len(result) - (len(result) % self.subsample)
-                    result_leftover = result[n_take:, :]
-                    if n_take == 0:
-                        continue
-                    result = result[:n_take, :]
-                    # take a mean of bucketed elements in buckets subsample size
-                    result = np.apply_along_axis(lambda m: np.mean(
-                        m.reshape(-1, self.subsample), axis=1), axis=0, arr=result)
+                first_new_sample = self.samples_written
+                # a time going backwards means the card was restarted
+                if first_new_sample > 0 and result[0, 0] < self.data_stream.time(first_new_sample - 1):
+                    self.run_start = first_new_sample
+                # only the latest samples fit in memory
+                if result.shape[0] > self.samples_in_memory:
+                    first_new_sample += result.shape[0] - self.samples_in_memory
+                    result = result[-self.samples_in_memory:]
                 n_samples = result.shape[0]
-
-                start_new_data_indx = (
-                    self.final_data_indx + 1) % self.samples_in_memory
-                final_new_data_indx = (
-                    start_new_data_indx + n_samples) % self.samples_in_memory
+                # tell the readers which samples are about to be overwritten
+                self.samples_reserved = first_new_sample + n_samples
 
                 # append the new data
-                if final_new_data_indx > start_new_data_indx:
-                    self.data_stream[start_new_data_indx:final_new_data_indx, :] = result
-                elif final_new_data_indx < start_new_data_indx:
-                    delta_indx = self.samples_in_memory - start_new_data_indx
-                    self.data_stream[start_new_data_indx:,
-                                     :] = result[:delta_indx]
-                    self.data_stream[:final_new_data_indx,
-                                     :] = result[delta_indx:]
-                else:
-                    self.data_stream = result
+                self.data_stream.write(first_new_sample, result)
+                # publish the new samples
                 self.final_data_indx = (
-                    final_new_data_indx - 1) % self.samples_in_memory
+                    first_new_sample + n_samples - 1) % self.samples_in_memory
+                self.samples_written = first_new_sample + n_samples
                 self.data_lock.release()
+                self.notify_time(result[-1, 0])
+                self.ni_queue.delivered(n_received)
+                self.check_dropped()
         except:
             traceback.print_exc()
             warnings.warn('An error occurred while reading the instrument: ' +
                           self.name + " Stopping reading thread")
 
+    def check_dropped(self):
+        """Warns if the NI process had to drop data because this instrument was not reading fast enough"""
+        dropped = self.ni_queue.get_stats()['chunks_dropped']
+        if dropped > self.warned_dropped:
+            warnings.warn('{}: {} chunks of data dropped so far, the instrument is not reading fast enough'.format(
+                self.name, int(dropped)))
+            self.warned_dropped = dropped
+
+    def get_stats(self):
+        """Returns the transport statistics of the data coming from the NI process (see NIqueue.get_stats)"""
+        return self.ni_queue.get_stats()
+
+    def get_snapshot(self):
+        """Lock free snapshot of the data stream for reading.
+
+        The data stream has a single writer (update_data_worker) and is read without locks: take a snapshot, copy
+        the wanted samples out of it, then check with is_intact that they were not overwritten in the meantime
+        (otherwise take a new snapshot and repeat).
+
+        Returns:
+            (resize sequence, data stream, first, last + 1) where first and last are the sample numbers of the
+            current time run kept in the data stream
+        """
+        while True:
+            sequence = self.resize_sequence
+            if sequence % 2 == 0:
+                break
+            # the data stream is being resized
+            time.sleep(0)
+        data_stream = self.data_stream
+        last = self.samples_written
+        first = max(self.run_start, last - data_stream.n_samples)
+        return sequence, data_stream, min(first, last), last
+
+    def is_intact(self, sequence, first):
+        """True if the data stream was not resized since the snapshot and the samples from first on are not
+        being overwritten"""
+        return self.resize_sequence == sequence and self.samples_reserved - self.samples_in_memory <= first
+
+    def find_window(self, start_time, end_time):
+        """Snapshots the data stream and finds the samples in the time window (see get_raw_data).
+        Returns (resize sequence, data stream, first, last + 1)"""
+        sequence, data_stream, first, last = self.get_snapshot()
+        if last > first:
+            # if start time negative, assume it's the current time - wanted start time
+            if start_time < 0:
+                start_time = data_stream.time(last - 1) + start_time
+            first = data_stream.find_time(start_time, first, last)
+            if end_time >= 0:
+                last = data_stream.find_time(end_time, first, last)
+        return sequence, data_stream, first, max(first, last)
+
     def get_raw_data(self, start_time=0, end_time=-1):
         """Returns the hard-copied NI data in a pandas DF
 
             Args:
-                start_time: the starting time of data points
-                end_time: the last time taken. -1 means the last time acquired
+                start_time: the starting time of data points. Negative means that many seconds before the latest time
+                end_time: the first time not taken. -1 means up to and including the last time acquired
             Returns:
                 0-th row is always time, n-th row corresponds to the n-th port in self.ports
         """
-        self.data_lock.acquire(True)
-        last_data_time = self.data_stream[self.final_data_indx, 0]
-        start_data_indx = (self.final_data_indx
-                           + 1) % self.samples_in_memory
-        start_data_time = self.data_stream[start_data_indx, 0]
-        # if still starting up, change the start index to 0
-        if start_data_time <= 0:
-            start_data_indx = 0
-            start_data_time = self.data_stream[start_data_indx, 0]
-        if last_data_time == 0 or start_time > last_data_time or (end_time > 0 and end_time <= start_data_time):
-            # have not started acquiring data yet, the start time is bigger than the latest time,
-            # or end time smaller than the first time in memory; return empty
-            self.data_lock.release()
-            return pd.DataFrame(columns=self.ports.values())
-        # find the end index
-        if end_time < 0 or end_time > last_data_time:
-            # return up until the latest time in the memory
-            indx_end = self.final_data_indx
-        else:
-            delta_indx = np.round((last_data_time - end_time) *
-                                  self.rate).astype(int)
-            indx_end = (self.final_data_indx -
-                        delta_indx) % self.samples_in_memory
-        # if start time negative, assume it's the current time - wanted start time
-        if start_time < 0:
-            start_time = last_data_time + start_time
-        # find the start index
-        if start_time <= start_data_time:
-            indx_start = start_data_indx
-        else:
-            delta_indx = np.round(
-                (last_data_time - start_time) * self.rate).astype(int)
-            indx_start = (self.final_data_indx
-                          - delta_indx) % self.samples_in_memory
-            # sometimes it can happen that the rate is not perfectly uniform because of the
-
-        # get the data and format it in the pandas dataframe
-        if indx_start < indx_end:
-            selected_data = self.data_stream[indx_start:indx_end, :]
-        elif indx_start > indx_end:
-            selected_data = np.vstack(
-                (self.data_stream[indx_start:, :], self.data_stream[:indx_end, :]))
-        else:
-            selected_data = self.data_stream[indx_start, :][np.newaxis, :]
+        return self.to_dataframe(self.get_array(start_time, end_time, out=False))
 
+    def to_dataframe(self, selected_data):
+        """Puts the raw samples (time in the 0-th column) into a pandas DF as returned by get_raw_data"""
+        if selected_data.shape[0] == 0:
+            # have not started acquiring data yet or nothing in the window, return empty
+            return pd.DataFrame(columns=self.ports.values())
         data_out = pd.DataFrame(
-            selected_data[:, 1:], columns=self.ports.values(), index=pd.Index(data=selected_data[:, 0], name='t'), copy=True)
-        self.data_lock.release()
+            selected_data[:, 1:], columns=self.ports.values(), index=pd.Index(data=selected_data[:, 0], name='t'))
         return data_out
 
+    def get_cursor(self, start_time=None):
+        """Returns an NIdataCursor for reading the data incrementally
+
+            Args:
+                start_time: the first read returns the data from this time on (negative means that many seconds before
+                    the latest time). None starts with the next sample acquired
+        """
+        if start_time is None:
+            return NIdataCursor(self, self.samples_written)
+        sequence, data_stream, first, last = self.find_window(start_time, -1)
+        return NIdataCursor(self, first)
+
+    def get_array(self, start_time=0, end_time=-1, out=None):
+        """Returns the raw NI data without building a dataframe. Same time window as get_raw_data
+
+            Args:
+                start_time: the starting time of data points. Negative means that many seconds before the latest time
+                end_time: the first time not taken. -1 means up to and including the last time acquired
+                out (np.array): if given, the data is copied into the first rows of this array (needs to have
+                    enough rows and len(self.ports) + 1 columns). False returns a new copy
+            Returns:
+                if out is None, a list of up to two read-only views of the data stream (the window can wrap around
+                its end). The views are only valid until the data is overwritten, i.e. for about flushing_time.
+                With the float32 and int16 storage, the list holds a single decoded copy instead.
+                Otherwise the filled part of out. 0-th column is always time, n-th column corresponds to the n-th port
+        """
+        if out is None:
+            sequence, data_stream, first, last = self.find_window(start_time, end_time)
+            views = [v.view() for v in data_stream.views(first, last)]
+            for v in views:
+                v.flags.writeable = False
+            return views
+        while True:
+            sequence, data_stream, first, last = self.find_window(start_time, end_time)
+            result = data_stream.copy(first, last, None if out is False else out)
+            # if the writer got to the copied samples in the meantime, try again
+            if self.is_intact(sequence, first):
+                return result
+
+    def get_calibrated_array(self, start_time=0, end_time=-1, out=None, wait=True, calibration=None):
+        """Returns the calibrated NI data in a numpy array. Same arguments as get_data and get_array, but the
+        result is a copy (into out if it is given) with the time in the 0-th column.
+        Affine calibrations are applied in place, the others go through their dataframe inst2data."""
+        if wait and end_time > 0:
+            self.wait_for_time(end_time)
+        result = self.get_array(start_time, end_time, out=False if out is None else out)
+        return self.calibrate_array(result, calibration)
+
+    def calibrate_array(self, result, calibration=None):
+        """Calibrates the copied raw samples (time in the 0-th column) in place, see get_calibrated_array"""
+        if calibration is None:
+            calibration = self.calibration
+        affine = calibration.get_inst2data_affine()
+        if affine is not None:
+            apply_affine(result[:, 1:], affine)
+        elif result.shape[0] != 0:
+            try:
+                result[:, 1:] = np.asarray(calibration.inst2data(
+                    pd.DataFrame(result[:, 1:], columns=self.ports.values(), index=result[:, 0])))
+            except DangerousValue as err:
+                print(self.name)
+                print(err)
+                result[:, 1:] = np.asarray(err.data)
+        return result
+
     def get_last_data_point(self):
-        self.data_lock.acquire(True)
-        last_data_time = self.data_stream[self.final_data_indx, 0]
-        # have not started acquiring data yet, return empty
-        if last_data_time == 0:
-            self.data_lock.release()
+        while True:
+            sequence, data_stream, first, last = self.get_snapshot()
+            if last == 0:
+                # have not started acquiring data yet, return empty
+                return pd.DataFrame(columns=self.ports.values())
+            data_out = data_stream.copy(last - 1, last)[0]
+            if self.is_intact(sequence, last - 1):
+                break
+        if data_out[0] == 0:
             return pd.DataFrame(columns=self.ports.values())
-        data_out = self.data_stream[self.final_data_indx, :]
         last_data = pd.DataFrame(
             data_out[1:][np.newaxis, :], columns=self.ports.values(), index=np.array([data_out[0], ]))
-        self.data_lock.release()
         return last_data
 
     def get_time(self):
-        self.data_lock.acquire(True)
-        t = self.data_stream[self.final_data_indx, 0].copy()
-        self.data_lock.release()
-        return t
+        while True:
+            sequence, data_stream, first, last = self.get_snapshot()
+            t = data_stream.time(last - 1)
+            if self.is_intact(sequence, last - 1):
+                return t if last > 0 else 0.
 
     def get_next_refresh_time(self):
         if self.port_type == 'AO':
@@ -270,14 +457,49 @@ class NIinst(Instrument):
         else:
             return self.get_time() + self.controller.data_acquisition_period
 
-    def wait_for_time(self, t, stop_event=None):
-        """Blocks until time is surpassed or the stop event is set"""
-        while True:
-            if stop_event is not None and stop_event.is_set():
-                break
+    def subscribe_time(self, t):
+        """Returns a threading.Event which the data thread sets as soon as data with the time t (or later) is read
+
+            Args:
+                t: the time to wait for, in the card time (as returned by get_time)
+        """
+        event = threading.Event()
+        # the data thread publishes the data before taking the subscription lock, so either the time is
+        # already there or the data thread will see the subscription
+        with self.subscription_lock:
             if self.get_time() >= t:
+                event.set()
+            else:
+                heapq.heappush(self.time_subscriptions, (t, self.n_subscriptions, event))
+                self.n_subscriptions += 1
+        return event
+
+    def unsubscribe_time(self, event):
+        """Removes the subscription of the event returned by subscribe_time, if it is still waiting"""
+        with self.subscription_lock:
+            self.time_subscriptions = [s for s in self.time_subscriptions if s[2] is not event]
+            heapq.heapify(self.time_subscriptions)
+
+    def notify_time(self, t):
+        """Sets the events of all subscriptions up to the time t. Called by the data thread after every new chunk"""
+        with self.subscription_lock:
+            while len(self.time_subscriptions) != 0 and self.time_subscriptions[0][0] <= t:
+                heapq.heappop(self.time_subscriptions)[2].set()
+
+    def wait_for_time(self, t, stop_event=None):
+        """Blocks until time is surpassed or the stop event is set.
+        The data thread wakes this up as soon as the time is read (see subscribe_time), the stop event is checked
+        every stop_check_period"""
+        if stop_event is not None and stop_event.is_set():
+            return
+        reached = self.subscribe_time(t)
+        if stop_event is None:
+            reached.wait()
+            return
+        while not reached.wait(self.stop_check_period):
+            if stop_event.is_set():
+                self.unsubscribe_time(reached)
                 break
-            time.sleep(0.01)
 
     def get_data(self, start_time=0, end_time=-1, wait=True, calibration=None):
         """Returns the calibrated hard-copied NI data in a numpy array
@@ -292,11 +514,19 @@ class NIinst(Instrument):
         """
         if wait and end_time > 0:
             self.wait_for_time(end_time)
+        if (self.calibration if calibration is None else calibration).get_inst2data_affine() is not None:
+            # affine calibrations are a single matrix multiplication on the copied samples
+            return self.to_dataframe(self.get_calibrated_array(start_time, end_time, wait=False,
+                                                               calibration=calibration))
+        raw_data = self.get_raw_data(
+            start_time=start_time, end_time=end_time)
+        return self.calibrate(raw_data, calibration)
+
+    def calibrate(self, raw_data, calibration=None):
+        """Calibrates the dataframe of raw data. If the calibration is None, the objects predefined calibration is used"""
         if calibration is None:
             calibration = self.calibration
         try:
-            raw_data = self.get_raw_data(
-                start_time=start_time, end_time=end_time)
             result = calibration.inst2data(raw_data)
         except DangerousValue as err:
             print(self.name)
@@ -341,7 +571,9 @@ class NIinst(Instrument):
         Args:
             functions: Desired functions to be outputted. The functions need to take a
                 time vector and return the desired output at each point of the time vector
-            periods: Period of the function repetition. Can be a number or a list of numbers
+            periods: Period of the function repetition. Can be a number or a list of numbers. With a calibration
+                which mixes the ports (see InstrumentCalibration.is_separable), different periods are calibrated
+                over their least common multiple, and a ValueError is raised if that is over max_staged_samples
             autostart: True if the output to the NI card should immediately be written, False otherwise
             index_reset: True resets the current output and starts outputting the new one immediately, False continues once the old one is finished
             use_calibration: weather or not to use the calibration, or just inputting the raw data. If the calibration is not used, that also means that the feedback is turned off.
@@ -374,58 +606,83 @@ class NIinst(Instrument):
         # prepare the time vector
         rate = self.controller.rate
         # number of steps needs to be an integer, so need to calculate that first
-        num_steps = np.lcm.reduce([int(np.round(p * rate)) for p in periods])
-        t_vector = 1 / rate * np.array(range(num_steps))
-        # get the physical signal from each of the functions
-        fn_eval = np.vstack([f(t_vector) for f in functions])
-        assert (len(fn_eval) == len(t_vector)) or (np.shape(fn_eval)[1] == len(
-            t_vector)), "The functions need to return a vector of equal length to the input t_vector!"
-        # turn the signal to pandas dataframe for calibration
-        physical_signal = pd.DataFrame(fn_eval.transpose(), columns=self.ports)
-        physical_signal.index = t_vector
-        # calibrate the physical signal to get voltages
-        if use_calibration:
-            # if there is no feedback, calibration should just give the signal. Otherwise, need to also pass the setpoint
-            if self.feedback is None:
-                signal = calibration.data2inst(physical_signal)
-            else:
-                signal, setpoint = calibration.data2inst(
-                    physical_signal, return_setpoint=True)
-                self.feedback.setpoint = setpoint
-                # update feedback in the controller
-                self.controller.feedback_receivers[self.name][0] = self.feedback
-        else:
-            signal = physical_signal
-            # # if there is feedback, make sure it's set to default (always 0)
-            # if self.feedback is not None:
-            #     self.controller.feedback_receivers[self.name][0] = NIFeedbackController(
-            #         self)
-        # if the calibration returns the signal in a form of a list, then this is handled with a new thread
-        # the full signal from the list is output, at the end of which only the last entry is iterated over
-        # in this case, autostart=False is not supported
-        if isinstance(signal, list):
-            assert autostart, "If the calibration is outputting a changing signal, autostart has to be false"
-            signal_out = signal[0]
-            signal_repetition = signal[-1]
-            t_repetition = (
-                signal_out.shape[0] - signal_repetition.shape[0] / 2) / rate
-        else:
-            signal_out = signal
+        port_steps = [int(np.round(p * rate)) for p in periods]
+        if len(set(port_steps)) > 1 and (not use_calibration or calibration.is_separable()):
+            # every port keeps its own period, the IO process repeats the waveform of every port separately
+            to_stage = {}
+            for port, f, num_steps in zip(self.ports, functions, port_steps):
+                t_vector = 1 / rate * np.arange(num_steps)
+                # the calibration of a port does not depend on the others, so they can just be zeros
+                physical_signal = pd.DataFrame(np.zeros((num_steps, len(self.ports))), columns=self.ports,
+                                               index=t_vector)
+                physical_signal[port] = f(t_vector)
+                signal = self.calibration_cache.data2inst(calibration, physical_signal) if use_calibration \
+                    else physical_signal
+                to_stage[port] = np.array(signal[port], dtype=float)
             signal_repetition = None
             t_repetition = -1
+        else:
+            # the calibration mixes the ports, so they all need the same (least common multiple) period
+            num_steps = np.lcm.reduce(port_steps)
+            # checked before evaluating anything, a waveform of this size takes minutes and gigabytes to calibrate
+            if num_steps > self.max_staged_samples:
+                raise ValueError(
+                    'The periods {} only repeat together after {:.0f} s ({} samples per port, the limit is {}). '
+                    'The calibration {} mixes the ports, so they can not repeat at their own periods: use periods '
+                    'with a short common multiple (e.g. the same period for every port), or stage the ports '
+                    'without the calibration'.format(periods, num_steps / rate, num_steps, self.max_staged_samples,
+                                                     type(calibration).__name__))
+            t_vector = 1 / rate * np.array(range(num_steps))
+            # get the physical signal from each of the functions
+            fn_eval = np.vstack([f(t_vector) for f in functions])
+            assert (len(fn_eval) == len(t_vector)) or (np.shape(fn_eval)[1] == len(
+                t_vector)), "The functions need to return a vector of equal length to the input t_vector!"
+            # turn the signal to pandas dataframe for calibration
+            physical_signal = pd.DataFrame(fn_eval.transpose(), columns=self.ports)
+            physical_signal.index = t_vector
+            # calibrate the physical signal to get voltages
+            if use_calibration:
+                # if there is no feedback, calibration should just give the signal. Otherwise, need to also pass the setpoint
+                if self.feedback is None:
+                    signal = self.calibration_cache.data2inst(calibration, physical_signal)
+                else:
+                    signal, setpoint = self.calibration_cache.data2inst(
+                        calibration, physical_signal, return_setpoint=True)
+                    self.feedback.setpoint = setpoint
+                    # update feedback in the controller
+                    self.controller.feedback_receivers[self.name][0] = self.feedback
+            else:
+                signal = physical_signal
+                # # if there is feedback, make sure it's set to default (always 0)
+                # if self.feedback is not None:
+                #     self.controller.feedback_receivers[self.name][0] = NIFeedbackController(
+                #         self)
+            # if the calibration returns the signal in a form of a list, then this is handled with a new thread
+            # the full signal from the list is output, at the end of which only the last entry is iterated over
+            # in this case, autostart=False is not supported
+            if isinstance(signal, list):
+                assert autostart, "If the calibration is outputting a changing signal, autostart has to be false"
+                signal_out = signal[0]
+                signal_repetition = signal[-1]
+                t_repetition = (
+                    signal_out.shape[0] - signal_repetition.shape[0] / 2) / rate
+            else:
+                signal_out = signal
+                signal_repetition = None
+                t_repetition = -1
+            to_stage = {p: np.array(signal_out[p]) for p in self.ports}
         # make sure that the data we are about to stage does not exceed 10V
-        if (signal_out > 10).any(axis=None) or (signal_out < -10).any(axis=None):
+        if any(np.any(np.abs(s) > 10) for s in to_stage.values()):
             warnings.warn(
                 '{} instrument input out of range!'.format(self.name))
-            signal_out[signal_out > 10] = 10
-            signal_out[signal_out < -10] = -10
-        to_stage = {p: np.array(signal_out[p]) for p in self.ports}
+            for s in to_stage.values():
+                np.clip(s, -10, 10, out=s)
         # stage the data
         self.controller.stage_data(to_stage, index_reset=index_reset)
         # start if autostart flag True
         if autostart:
             # if IO process is running, change the output
-            if self.controller.IO_process.is_alive():
+            if self.controller.is_running():
                 start_time = self.controller.change_output()
             # if IO process not running, start it
             else:
@@ -443,7 +700,7 @@ class NIinst(Instrument):
     def output_at_time(self, start_time, signal, stop_event=None):
         """Waits for the start_time and outputs the signal_repetition as soon as
         that time passes without reseting the ni output index. Stop event can stop the output if triggered before the start time"""
-        assert self.controller.IO_process.is_alive()
+        assert self.controller.is_running()
         to_stage = {p: np.array(signal[p]) for p in self.ports}
         self.controller.stage_data(to_stage, index_reset=False)
         self.wait_for_time(start_time, stop_event=stop_event)
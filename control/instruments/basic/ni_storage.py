@@ -0,0 +1,222 @@
+import tempfile
+import numpy as np
+
+
+def allocate(shape, dtype, memmap_threshold=None, memmap_dir=None, prefix='ni_'):
+    """Returns a zeroed array. If it is bigger than memmap_threshold bytes, it is backed by a temporary file in
+    memmap_dir, so the operating system only keeps the recently used pages in memory.
+    The file is deleted once the array is not used anymore"""
+    dtype = np.dtype(dtype)
+    if memmap_threshold is None or dtype.itemsize * int(np.prod(shape)) <= memmap_threshold:
+        return np.zeros(shape, dtype=dtype)
+    return np.memmap(tempfile.TemporaryFile(prefix=prefix, dir=memmap_dir), dtype=dtype, mode='w+', shape=shape)
+
+
+def segments(first, last, n_samples):
+    """Returns the list of up to two (start, end) row ranges holding the samples between first and last
+    in a ring of n_samples rows"""
+    indx_first = first % n_samples
+    indx_last = indx_first + max(last - first, 0)
+    if indx_last <= n_samples:
+        return [(indx_first, indx_last)]
+    return [(indx_first, n_samples), (0, indx_last - n_samples)]
+
+
+class NIfloatStorage:
+    """Data stream of an NIinst keeping the samples as float64 rows of time and port values.
+    Sample n is kept in row n % n_samples.
+
+    Only one thread writes, the NIinst readers check that the samples they copied were not overwritten.
+
+        Args:
+            n_samples (int): number of samples kept
+            n_ports (int): number of ports (columns without the time)
+            rate (num): sampling rate of the data
+            memmap_threshold, memmap_dir: see allocate
+            prefix (str): prefix of the memory mapped file name
+    """
+    dtype = np.dtype(float)
+
+    def __init__(self, n_samples, n_ports, rate, memmap_threshold=None, memmap_dir=None, prefix='ni_'):
+        self.n_samples = int(n_samples)
+        self.n_ports = n_ports
+        self.rate = rate
+        self.data = allocate((self.n_samples, n_ports + 1), self.dtype, memmap_threshold, memmap_dir, prefix)
+
+    @property
+    def nbytes(self):
+        return self.data.nbytes
+
+    def write(self, first, chunk):
+        """Writes the chunk (time in the 0-th column) as the samples from first on. The chunk can not be longer
+        than the storage"""
+        n = 0
+        for start, end in segments(first, first + chunk.shape[0], self.n_samples):
+            self.data[start:end] = chunk[n:n + end - start]
+            n += end - start
+
+    def time(self, n):
+        """Returns the time of the sample n"""
+        return self.data[n % self.n_samples, 0]
+
+    def find_time(self, t, first, last):
+        """Returns the number of the first sample between samples first and last with the time not smaller than t
+        (to half a sample), or last if there is none. The times are increasing but can wrap around the end of the
+        data stream, so this is a binary search in each of the (up to two) segments."""
+        t = t - 0.5 / self.rate
+        n = first
+        for start, end in segments(first, last, self.n_samples):
+            i = np.searchsorted(self.data[start:end, 0], t)
+            if i < end - start:
+                return n + i
+            n += end - start
+        return last
+
+    def views(self, first, last):
+        """Returns a list of up to two views of the samples between first and last"""
+        return [self.data[start:end] for start, end in segments(first, last, self.n_samples)]
+
+    def copy(self, first, last, out=None):
+        """Copies the samples between first and last into the first rows of out (a new array if None).
+        Returns the filled part"""
+        if out is None:
+            out = np.empty((last - first, self.n_ports + 1))
+        else:
+            assert out.shape[0] >= last - first, 'out needs at least {} rows'.format(last - first)
+        n = 0
+        for start, end in segments(first, last, self.n_samples):
+            out[n:n + end - start] = self.data[start:end]
+            n += end - start
+        return out[:n]
+
+    def copy_from(self, other, first, last, block_size=65536):
+        """Copies the samples between first and last from another storage, block by block"""
+        for n in range(first, last, block_size):
+            self.write(n, other.copy(n, min(n + block_size, last)))
+
+
+class NIcompactStorage(NIfloatStorage):
+    """Data stream of an NIinst keeping only the port values, as float32 or as int16 codes, and no time column.
+
+    The time of sample n is implicit: t0 + (n - n0) / rate, where (n0, t0) is the latest time anchor at or
+    before n. A new anchor is only added when the time of a written sample is more than time_tolerance away
+    from the implicit one (card restarts, gaps or drift), so the anchor table stays sparse.
+    int16 codes are value = code * scale + offset, with the range split into 65535 steps. Values outside
+    the range are clipped.
+
+        Args:
+            n_samples (int): number of samples kept
+            n_ports (int): number of ports
+            rate (num): sampling rate of the data
+            dtype: "float32" or "int16"
+            value_range (tuple): (minimum, maximum) value that can be stored as int16
+            time_tolerance (num): maximum difference from the implicit time in s, half a sample if None
+            memmap_threshold, memmap_dir, prefix: see NIfloatStorage
+    """
+
+    def __init__(self, n_samples, n_ports, rate, dtype='float32', value_range=(-10, 10), time_tolerance=None,
+                 memmap_threshold=None, memmap_dir=None, prefix='ni_'):
+        self.dtype = np.dtype(dtype)
+        assert self.dtype in {np.dtype('float32'), np.dtype('int16')}, 'Unknown storage type {}'.format(dtype)
+        self.n_samples = int(n_samples)
+        self.n_ports = n_ports
+        self.rate = rate
+        self.data = allocate((self.n_samples, n_ports), self.dtype, memmap_threshold, memmap_dir, prefix)
+        if self.dtype == np.dtype('int16'):
+            self.scale = (value_range[1] - value_range[0]) / 65535
+            self.offset = (value_range[1] + value_range[0]) / 2
+        self.time_tolerance = 0.5 / rate if time_tolerance is None else time_tolerance
+        # sample numbers and times of the anchors. Replaced together, so a reader always sees a matching pair
+        self.anchors = (np.zeros(0, dtype=np.int64), np.zeros(0))
+
+    def write(self, first, chunk):
+        self.add_anchors(first, chunk[:, 0])
+        values = chunk[:, 1:]
+        if self.dtype == np.dtype('int16'):
+            values = np.clip(np.rint((values - self.offset) / self.scale), -32767, 32767)
+        n = 0
+        for start, end in segments(first, first + chunk.shape[0], self.n_samples):
+            self.data[start:end] = values[n:n + end - start]
+            n += end - start
+
+    def add_anchors(self, first, t):
+        """Adds the anchors needed for the times t of the samples from first on"""
+        samples, times = self.anchors
+        new_samples, new_times = [], []
+        n = 0
+        while n < t.size:
+            if len(new_samples) == 0 and samples.size == 0:
+                i = 0
+            else:
+                n0, t0 = (new_samples[-1], new_times[-1]) if len(new_samples) != 0 else (samples[-1], times[-1])
+                implicit = t0 + (np.arange(first + n, first + t.size) - n0) / self.rate
+                off = np.flatnonzero(np.abs(t[n:] - implicit) > self.time_tolerance)
+                if off.size == 0:
+                    break
+                i = off[0]
+            new_samples.append(first + n + i)
+            new_times.append(t[n + i])
+            n += i + 1
+        if len(new_samples) == 0:
+            return
+        # drop the anchors of the samples which are overwritten, keeping the one the kept samples start from
+        keep = max(np.searchsorted(samples, first + t.size - self.n_samples, side='right') - 1, 0)
+        self.anchors = (np.concatenate((samples[keep:], new_samples)).astype(np.int64),
+                        np.concatenate((times[keep:], new_times)))
+
+    def times(self, first, last):
+        """Returns the times of the samples between first and last"""
+        samples, times = self.anchors
+        result = np.arange(first, last, dtype=float)
+        # go through the anchor segments overlapping the samples
+        k = max(np.searchsorted(samples, first, side='right') - 1, 0)
+        while True:
+            start = max(first, samples[k]) - first
+            end = last - first if k + 1 == samples.size else min(last, samples[k + 1]) - first
+            segment = result[start:end]
+            segment -= samples[k]
+            segment /= self.rate
+            segment += times[k]
+            if end >= last - first:
+                return result
+            k += 1
+
+    def time(self, n):
+        if self.anchors[0].size == 0:
+            return 0.
+        return self.times(n, n + 1)[0]
+
+    def find_time(self, t, first, last):
+        samples, times = self.anchors
+        t = t - 0.5 / self.rate
+        # go through the anchor segments overlapping the samples
+        k = max(np.searchsorted(samples, first, side='right') - 1, 0)
+        while True:
+            start = max(first, samples[k])
+            end = last if k + 1 == samples.size else min(last, samples[k + 1])
+            n = max(samples[k] + int(np.ceil((t - times[k]) * self.rate)), start)
+            if n < end or end == last:
+                return int(min(n, last))
+            k += 1
+
+    def views(self, first, last):
+        # there is nothing to view, the data needs to be decoded
+        return [self.copy(first, last)]
+
+    def copy(self, first, last, out=None):
+        if out is None:
+            out = np.empty((last - first, self.n_ports + 1))
+        else:
+            assert out.shape[0] >= last - first, 'out needs at least {} rows'.format(last - first)
+        if self.anchors[0].size == 0:
+            return out[:0]
+        out[:last - first, 0] = self.times(first, last)
+        n = 0
+        for start, end in segments(first, last, self.n_samples):
+            if self.dtype == np.dtype('int16'):
+                np.multiply(self.data[start:end], self.scale, out=out[n:n + end - start, 1:])
+                out[n:n + end - start, 1:] += self.offset
+            else:
+                out[n:n + end - start, 1:] = self.data[start:end]
+            n += end - start
+        return out[:n]
@@ -0,0 +1,81 @@
+import numpy as np
+
+
+class BucketMean:
+    """Boxcar and decimate: averages every subsample consecutive rows (all columns, including the time) into one.
+
+    Rows which do not fill a whole bucket are carried over to the next chunk in a preallocated buffer,
+    so every chunk costs one reshape and one mean.
+
+    Args:
+        subsample (int): number of rows averaged into one
+        n_columns (int): number of columns of the chunks
+    """
+
+    def __init__(self, subsample, n_columns):
+        self.subsample = int(subsample)
+        self.carry = np.empty((self.subsample, n_columns))
+        self.n_carry = 0
+
+    def process(self, chunk):
+        """Returns the averaged rows of all buckets completed by the chunk (can be none)"""
+        n_total = self.n_carry + chunk.shape[0]
+        n_out = n_total // self.subsample
+        if n_out == 0:
+            self.carry[self.n_carry:n_total] = chunk
+            self.n_carry = n_total
+            return chunk[:0]
+        result = np.empty((n_out, chunk.shape[1]))
+        # the first bucket starts with the carried rows
+        n_first = self.subsample - self.n_carry
+        self.carry[self.n_carry:] = chunk[:n_first]
+        np.mean(self.carry, axis=0, out=result[0])
+        # the other buckets are all in the chunk
+        n_end = n_first + (n_out - 1) * self.subsample
+        np.mean(chunk[n_first:n_end].reshape(n_out - 1, self.subsample, chunk.shape[1]), axis=1, out=result[1:])
+        self.n_carry = chunk.shape[0] - n_end
+        self.carry[:self.n_carry] = chunk[n_end:]
+        return result
+
+
+class CICDecimator:
+    """Cascaded integrator-comb decimation: order moving averages of length subsample, then keeps every
+    subsample-th row. Suppresses the aliasing of the bucket mean (which is order 1) at the cost of a delay of
+    order * (subsample - 1) / 2 rows. The time column goes through the same filter, so it stays aligned with the data.
+
+    The moving averages are computed from cumulative sums over each chunk, with the last subsample - 1 rows of every
+    stage kept for the next chunk.
+
+    Args:
+        subsample (int): decimation factor and length of the moving averages
+        n_columns (int): number of columns of the chunks
+        order (int): number of moving average stages
+    """
+
+    def __init__(self, subsample, n_columns, order=3):
+        self.subsample = int(subsample)
+        self.order = int(order)
+        assert self.order >= 1, 'CIC order needs to be at least 1'
+        self.n_columns = n_columns
+        # the rows of every stage not yet summed over a full window, filled with the first row on the first chunk
+        self.history = None
+        # number of rows processed so far, keeps the decimation phase between chunks
+        self.n_processed = 0
+
+    def process(self, chunk):
+        """Returns the decimated output rows produced by the chunk (can be none)"""
+        if chunk.shape[0] == 0:
+            return chunk
+        if self.history is None:
+            self.history = [np.repeat(chunk[:1], self.subsample - 1, axis=0) for _ in range(self.order)]
+        x = chunk
+        for stage in range(self.order):
+            extended = np.concatenate((self.history[stage], x))
+            cumulative = np.zeros((extended.shape[0] + 1, self.n_columns))
+            np.cumsum(extended, axis=0, out=cumulative[1:])
+            self.history[stage] = extended[extended.shape[0] - (self.subsample - 1):]
+            x = (cumulative[self.subsample:] - cumulative[:-self.subsample]) / self.subsample
+        # keep the last row of every bucket, the same rows the bucket mean ends on
+        first = (-(self.n_processed + 1)) % self.subsample
+        self.n_processed += chunk.shape[0]
+        return x[first::self.subsample]
@@ -62,17 +62,23 @@ class ClosedNewport(Instrument):
     def update_position_worker(self):
         """Continuously updates the position of the motor"""
         sleep_t = 0.1
-        # before we start, get all the data and calculate how much we moved
+        # last sample of the previous data, so that the steps between the two reads are counted as well
+        last_data = None
         try:
+            # before we start, get all the data and calculate how much we moved
+            cursor = self.instruments['angle_measurement'].get_cursor(start_time=self.last_update_t)
             while not self.update_position_stop.is_set():
                 time.sleep(sleep_t)
-                # get the data from the angle measurement
-                self.last_update_t_lock.acquire(True)
-                data = self.instruments['angle_measurement'].get_data(start_time=self.last_update_t)
-                self.last_update_t_lock.release()
+                # get the new data from the angle measurement
+                data, overrun = cursor.get_new_data()
                 if data.shape[0] == 0:
                     # print('no closed newport data')
                     continue
+                if overrun:
+                    warnings.warn('Angle measurement data was lost, the newport position might be off')
+                elif last_data is not None:
+                    data = pd.concat((last_data, data))
+                last_data = data.iloc[-1:]
                 # print('Acquired times: ', data.index[0], data.index[-1])
                 chA = np.array(data[data.columns[::2]]).astype(float)
                 chB = np.array(data[data.columns[1::2]]).astype(float)
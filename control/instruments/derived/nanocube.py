@@ -1,7 +1,6 @@
 from ..basic.ni_instrument import NIinst
 import threading
 import numpy as np
-import copy
 from data.signal_generation import stack_funs, get_const_signal
 import pandas as pd
 
@@ -27,13 +26,12 @@ class NanoCube(NIinst):
 
     def get_position(self):
         # gets the last sample read
-        self.data_lock.acquire(True)
-        try:
-            pos = copy.deepcopy(self.data_stream[-1][1:])
-        except IndexError:
+        last_data = self.get_last_data_point()
+        if last_data.shape[0] == 0:
             # if nothing in the data stream, means that you are at 0, 0, 0
             pos = pd.DataFrame(np.zeros((1, 3)), columns=self.ports.values())
-        self.data_lock.release()
+        else:
+            pos = np.array(last_data)[0]
         return np.array(self.calibration.inst2data(pos))
 
     def slide_to_position(self, position):
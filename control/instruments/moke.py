@@ -100,6 +100,11 @@ class Moke(Instrument):
                 except:
                     traceback.print_exc()
 
+    def get_ni_stats(self):
+        """Returns a dictionary of instrument name: statistics of the data transport from the NI cards.
+        Useful for checking if any of the instruments dropped data during a long experiment"""
+        return {key: inst.get_stats() for key, inst in self.instruments.items() if hasattr(inst, 'ni_queue')}
+
     def save(self, group, name=None):
         """Iterates through all of the instruments and saves them with their respective methods"""
         group.attrs['type'] = self.__class__.__name__
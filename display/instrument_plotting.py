@@ -55,6 +55,10 @@ class NIPlotting(InstrumentPlotting):
         self.plotting_data = pd.DataFrame()
         self.first_run = True
         self.lines = dict()
+        # calibration of the plotted data, None is the device calibration
+        self.calibration = None
+        # reads the new data of the device incrementally, created on the first update
+        self.cursor = None
         # self.plotting_data = self.update_plotting_data()
 
         # self.plt._setProxyOptions(deferGetattr=True)  ## speeds up access to rplt.plot
@@ -67,7 +71,11 @@ class NIPlotting(InstrumentPlotting):
             start_time = np.max(
                 (self.device.get_time() - self.plotting_time, 0))
         # get the most recent data
-        data = self.device.get_data(start_time=start_time)
+        data = self.device.get_data(start_time=start_time, calibration=self.calibration)
+        return self.process_plot_data(data)
+
+    def process_plot_data(self, data):
+        """Undersamples and smooths the data to data_per_second points"""
         if data.shape[0] != 0:
             time_interval = data.index[-1] - data.index[0]
             # if too few data, just continue
@@ -86,18 +94,27 @@ class NIPlotting(InstrumentPlotting):
 
     def update_plotting_data(self):
         # get the data and concat to the existing data
-        if self.plotting_data.shape[0] != 0:
-            start_new_data_time = self.plotting_data.index[-1]
-            data = self.get_plot_data(
-                start_time=start_new_data_time)
+        if self.cursor is not None and self.plotting_data.shape[0] != 0:
+            # only take the new data once there is enough of it for a plotted point
+            data, overrun = self.cursor.get_new_data(
+                min_samples=int(np.ceil(self.device.rate / self.data_per_second)) + 1, calibration=self.calibration)
+            if data.shape[0] == 0:
+                return False
+            data = self.process_plot_data(data)
             if data.shape[0] == 0:
                 return False
-            self.plotting_data = pd.concat((self.plotting_data, data))
+            if overrun or data.index[0] < self.plotting_data.index[-1]:
+                # missed some data or the card was restarted, start over
+                self.plotting_data = data
+            else:
+                self.plotting_data = pd.concat((self.plotting_data, data))
             # flush extra data
             self.plotting_data = self.plotting_data.loc[
                 self.plotting_data.index > self.plotting_data.index[-1] - self.plotting_time]
         else:
-            self.plotting_data = self.get_plot_data()
+            self.cursor = self.device.get_cursor(start_time=-self.plotting_time)
+            data, overrun = self.cursor.get_new_data(calibration=self.calibration)
+            self.plotting_data = self.process_plot_data(data)
         return True
 
     def plot(self):
@@ -201,12 +218,7 @@ class HPplotting(NIPlotting):
         else:
             self.calibration = device.calibration
 
-    def get_plot_data(self, start_time=None):
-        if start_time is None:
-            start_time = self.device.get_time() - self.plotting_time
-        # get the most recent data
-        data = self.device.get_data(
-            start_time=start_time, calibration=self.calibration)
+    def process_plot_data(self, data):
         if data.shape[0] != 0:
             # get how many samples we are getting (aim for about 50 per second here)
             update_samples = int(self.data_per_second
@@ -242,21 +254,9 @@ class WollastonPlotting(NIPlotting):
             p.addLegend()
         assert isinstance(plt, dict)
 
-    def update_plotting_data(self):
-        if self.plotting_data.shape[0] != 0:
-            # get the data and concat to the existing data
-            data = self.get_plot_data(
-                start_time=self.plotting_data.index[-1])
-            # get wollaston processed data
-            data = processing.wollaston_data(data)
-            self.plotting_data = pd.concat((self.plotting_data, data))
-            # flush extra data
-            self.plotting_data = self.plotting_data.loc[
-                self.plotting_data.index > self.plotting_data.index[-1] - self.plotting_time]
-        else:
-            data = self.get_plot_data()
-            # get wollaston processed data
-            self.plotting_data = processing.wollaston_data(data)
+    def process_plot_data(self, data):
+        # get wollaston processed data
+        return processing.wollaston_data(super().process_plot_data(data))
 
     def plot(self):
         self.update_plotting_data()
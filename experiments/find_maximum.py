@@ -5,11 +5,12 @@ import time
 def get_woll_signal(woll, time_increment=0.2, delay=0.2):
     "Gets the mean wollaston signal during the last time_increment"
     start_time = woll.get_time() + delay
-    signal = woll.get_data(start_time=start_time,
-                           end_time=start_time + time_increment)
+    signal = woll.get_calibrated_array(start_time=start_time,
+                                       end_time=start_time + time_increment)
 
-    #Detector arm for "auto-find the maximum"
-    signal_out = np.mean((signal['det2']).values)
+    #Detector arm for "auto-find the maximum" (column 0 is the time)
+    det2_column = list(woll.ports.values()).index('det2') + 1
+    signal_out = np.mean(signal[:, det2_column])
 
     return signal_out
 
@@ -76,7 +76,7 @@ def take_steps(moke, signals, stop_event, saving_loc, data_callback, experiment_
             image_data = np.mean(image_data, axis=2)
         info_grp.create_dataset('reference_image_no_field', data=image_data)
 
-    start_time = hexapole.get_data(start_time=0, end_time=-1).index[-1]
+    start_time = hexapole.get_time()
     last_signal_end_time = start_time
     sleep(0.1)
 
@@ -114,7 +114,7 @@ def take_steps(moke, signals, stop_event, saving_loc, data_callback, experiment_
                                         autostart=True, index_reset=True)
                     if print_all_info: print('    --> last loops PID result sent to hexapole')
                     sleep(0.0001)   # NOTE maybe not needed
-                    last_signal_end_time = hexapole.get_data(start_time=last_signal_end_time, end_time=-1).index[-1]
+                    last_signal_end_time = hexapole.get_time()
                     sleep(0.0001)   # NOTE maybe not needed
 
                 # Just get the last nb_points_used_for_tuning of hexapole & hp for PID
@@ -151,7 +151,7 @@ def take_steps(moke, signals, stop_event, saving_loc, data_callback, experiment_
 
                     # Save all the stuff to HDF
                     current_signal_stabilized_time = output_data.index[-1]
-                    time_all_images_were_taken = hexapole.get_data(start_time=-3, end_time=-1).index[-1]
+                    time_all_images_were_taken = hexapole.get_time()
                     append_save_instruments(moke, inst_grp, ['hexapole', 'hallprobe', 'bighall_fields'],
                                      start_time=last_signal_end_time, end_time=current_signal_stabilized_time)
                     nth_step_grp = step_grp.create_group(str(idx_step))
@@ -163,7 +163,7 @@ def take_steps(moke, signals, stop_event, saving_loc, data_callback, experiment_
                         image_data = np.mean(image_data, axis=2)
                     nth_step_grp.create_dataset('image_data', data=image_data)
                     data_callback(current_signal_stabilized_time, signal_measured.iloc[-1, :].values, image_data)
-                    time_all_data_saved_to_hdf = hexapole.get_data(start_time=-3, end_time=-1).index[-1]
+                    time_all_data_saved_to_hdf = hexapole.get_time()
                     nth_step_grp.attrs['time_all_data_saved_to_hdf'] = time_all_data_saved_to_hdf
                     last_signal_end_time = current_signal_stabilized_time
                     if print_all_info: print('    --> data written to HDF')
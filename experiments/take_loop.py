@@ -215,15 +215,9 @@ def create_loops_group(f):
 
 
 def wait_for_time(time_instrument, stop_event, end_time):
-    # wait for time while listening to the stop event
-    lagging = True
-    while True:
-        time.sleep(0.001)
-        if ((stop_event is not None) and (stop_event.is_set())) or (
-                time_instrument.get_time() >= end_time):
-            break
-        else:
-            lagging = False
+    # wait for time while listening to the stop event. Lagging if the time had already passed
+    lagging = time_instrument.get_time() >= end_time
+    time_instrument.wait_for_time(end_time, stop_event)
     return lagging
 
 
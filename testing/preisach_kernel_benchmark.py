@@ -0,0 +1,73 @@
+"""Compares the compiled Preisach inversion (reconstruct_hyst_signal) with the plain python reference, for speed and
+for the output. Uses made up F functions of the same form as MagnetHystCalib, so it does not need the calibration file."""
+import sys
+import time
+sys.path.append('.')
+import numpy as np
+from scipy.interpolate import UnivariateSpline, RectBivariateSpline
+from control.calibration.magnet_response_calibration import (
+    reconstruct_hyst_signal, reconstruct_hyst_signal_reference, filter_signal, PreisachFGrid)
+
+# waveform length in s and the rate of the card
+duration = 1
+rate = 10000
+repetitions = 2
+# resolution of the tabulated F functions
+F_grid_resolution = 401
+
+
+def get_F_functions(n_poles=3):
+    """F functions built like the MagnetHystCalib ones, from a major loop and a smooth transition surface"""
+    grid = np.linspace(-1.2, 1.2, 60)
+    F_functions = []
+    for pole in range(n_poles):
+        f_a = UnivariateSpline(grid, np.tanh((2 + pole) * grid), s=0)
+        a, b = np.meshgrid(grid, grid, indexing='ij')
+        f_ab = RectBivariateSpline(grid, grid, np.tanh((2 + pole) * a) * np.exp(-(a - b) ** 2))
+        F_functions.append(lambda a, b, f_a=f_a, f_ab=f_ab: (f_a.__call__(a) - f_ab.ev(a, b)) / 2)
+    return F_functions
+
+
+def get_degauss_line():
+    """Preisach line left by a decaying oscillation, as after degaussing"""
+    L = np.array([[1., -1.]])
+    n = 40
+    degauss = np.cos(np.pi * np.arange(n)) * np.linspace(1, 0.01, n)
+    return reconstruct_hyst_signal(degauss, L, lambda a, b: np.zeros(np.size(a)))[1]
+
+
+if __name__ == "__main__":
+    t0 = np.arange(int(duration * rate)) / rate
+    fields = [0.8 * np.sin(2 * np.pi * 3 * t0 + pole) + 0.1 * np.sin(2 * np.pi * 17 * t0) for pole in range(3)]
+    F_functions = get_F_functions()
+    start_l = get_degauss_line()
+    tic = time.perf_counter()
+    F_grids = [PreisachFGrid(F, -1.2, 1.2, F_grid_resolution) for F in F_functions]
+    print('F grids of {0}x{0} points made in {1:.0f} ms, maximum interpolation errors: {2}'.format(
+        F_grid_resolution, (time.perf_counter() - tic) * 1e3, ', '.join('{:.2e}'.format(F.get_max_error()) for F in F_grids)))
+    print('Starting line of {} points, {} s at {} Hz for three poles'.format(start_l.shape[0], duration, rate))
+    # compile first
+    reconstruct_hyst_signal(np.zeros(2), start_l, F_grids[0])
+
+    for filtered in [True, False]:
+        # the filtered signal is what MagnetHystCalib.get_required_input_pole inverts
+        signals = [filter_signal(t0, f)[1] if filtered else f for f in fields]
+        results = {}
+        for name, fun, F in [('reference', reconstruct_hyst_signal_reference, F_functions),
+                             ('compiled', reconstruct_hyst_signal, F_functions),
+                             ('compiled with F grid', reconstruct_hyst_signal, F_grids)]:
+            tic = time.perf_counter()
+            outputs = []
+            for pole in range(3):
+                line = start_l.copy()
+                for i in range(repetitions):
+                    out, line = fun(signals[pole], line, F[pole])
+                    outputs.append((out, line))
+            results[name] = outputs
+            print('{} signal ({} samples per pole), {}: {:.1f} ms'.format(
+                'filtered' if filtered else 'full', signals[0].size, name, (time.perf_counter() - tic) * 1e3))
+        for name in ['compiled', 'compiled with F grid']:
+            error = max(np.max(np.abs(out - ref)) for (out, _), (ref, _) in zip(results[name], results['reference']))
+            same_lines = all(np.array_equal(line, ref) for (_, line), (_, ref) in
+                             zip(results[name], results['reference']))
+            print('    {}: maximum difference {:.2e}, same Preisach lines: {}'.format(name, error, same_lines))
@@ -0,0 +1,70 @@
+"""Runs the NI part of the Moke on the simulated card and measures how much data gets to the instruments and how late.
+Does not need any hardware, so it can be run on any machine."""
+import sys
+import time
+import copy
+sys.path.append('.')
+import numpy as np
+from control.instruments.moke import Moke
+from control.load_from_settings import read_settings
+
+# how long to run for
+duration = 20
+# how often to poll the instruments
+poll_period = 0.01
+simulation = {
+    # hexapole outputs show up on the hallprobe
+    "echo": [{"output": "Dev2/ao0", "input": "Dev1/ai0", "gain": 0.1, "time_constant": 0.005},
+             {"output": "Dev2/ao2", "input": "Dev1/ai2", "gain": 0.1, "time_constant": 0.005},
+             {"output": "Dev2/ao4", "input": "Dev1/ai4", "gain": 0.1, "time_constant": 0.005}],
+    "noise": 0.001,
+    "jitter": 0.001
+}
+
+
+def get_settings(transport, acquisition):
+    settings_data = copy.deepcopy(read_settings())
+    # only keep the NI controllers and make them simulated
+    settings_data['controllers'] = [
+        cnt for cnt in settings_data['controllers'] if cnt["type"] in {"NIcardRTSI", "NIcard"}]
+    for cnt in settings_data['controllers']:
+        cnt['parameters']['simulation'] = simulation
+        cnt['parameters']['transport'] = transport
+        cnt['parameters']['acquisition'] = acquisition
+    # only keep the ni instruments, without the calibrations
+    settings_data['instruments'] = {
+        name: inst for name, inst in settings_data["instruments"].items() if inst["type"] == "NIinst"}
+    for inst in settings_data['instruments'].values():
+        inst.pop('calibration', None)
+    return settings_data
+
+
+def run_benchmark(transport, acquisition):
+    with Moke(get_settings(transport, acquisition)) as moke:
+        ni_instruments = moke.instruments
+        # wait for the data to start coming in
+        while any(inst.get_time() <= 0 for inst in ni_instruments.values()):
+            time.sleep(poll_period)
+        start_times = {name: inst.get_time() for name, inst in ni_instruments.items()}
+        wall_start = time.perf_counter()
+        # delay of the newest sample with respect to the wall clock, relative to the smallest one seen
+        lags = {name: [] for name in ni_instruments}
+        while time.perf_counter() - wall_start < duration:
+            wall = time.perf_counter() - wall_start
+            for name, inst in ni_instruments.items():
+                lags[name].append(wall - (inst.get_time() - start_times[name]))
+            time.sleep(poll_period)
+        wall = time.perf_counter() - wall_start
+        print('\nTransport: {}, acquisition: {}'.format(transport, acquisition))
+        for name, inst in ni_instruments.items():
+            lag = np.array(lags[name]) - np.min(lags[name])
+            n_samples = (inst.get_time() - start_times[name]) * inst.rate
+            print('{:>20}: {:8.0f} samples/s, lag mean {:6.1f} ms, max {:6.1f} ms'.format(
+                name, n_samples / wall, 1000 * np.mean(lag), 1000 * np.max(lag)))
+        moke.stop()
+
+
+if __name__ == "__main__":
+    for transport in ['queue', 'shared_memory']:
+        for acquisition in ['polling', 'event']:
+            run_benchmark(transport, acquisition)